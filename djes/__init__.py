@@ -1,4 +1,6 @@
 import djes.signals  # noqa
+from djes.buffer import batch_indexing  # noqa
+from djes.worker import background_indexing  # noqa
 
 __version__ = "0.1.110"
 
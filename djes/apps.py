@@ -36,6 +36,7 @@ class DJESConfig(AppConfig):
     verbose_name = "DJ E.S."
 
     def ready(self):
+        from .factory import shallow_class_factory
         from .models import Indexable
 
         # Let's register all the Indexable models
@@ -47,4 +48,8 @@ class DJESConfig(AppConfig):
                 if meta and not getattr(meta, "abstract"):
                     indexable_registry.register(model)
 
+        # Create all the search result classes now, rather than while hydrating results
+        for model in list(indexable_registry.all_models.values()):
+            shallow_class_factory(model)
+
     connections.configure(**settings.ES_CONNECTIONS)
@@ -0,0 +1,123 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections as db_connections, transaction
+from elasticsearch.helpers import BulkIndexError, bulk
+from elasticsearch_dsl.connections import connections
+
+from .builds import with_build_targets
+
+
+_local = threading.local()
+
+
+def _get_stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def get_current_buffer():
+    """Returns the innermost active `IndexingBuffer` for this thread, or `None`"""
+    stack = _get_stack()
+    if stack:
+        return stack[-1]
+    return None
+
+
+class IndexingBuffer(object):
+    """Collects index and delete operations so they can be sent as a single `_bulk` request.
+
+    Operations are keyed by index, doc_type and id, so writing the same object more than once only
+    sends the last operation."""
+
+    def __init__(self):
+        self.actions = OrderedDict()
+        self.refresh = False
+
+    def __len__(self):
+        return len(self.actions)
+
+    def add(self, action, refresh=False):
+        key = (action["_index"], action["_type"], action["_id"])
+        # Move repeated writes to the end, so that the last write wins and is sent last
+        self.actions.pop(key, None)
+        self.actions[key] = action
+        self.refresh = self.refresh or refresh
+
+    def merge(self, other):
+        """Adds all of the operations from another buffer to this one"""
+        for action in other.actions.values():
+            self.add(action, refresh=other.refresh)
+
+    def clear(self):
+        self.actions.clear()
+        self.refresh = False
+
+    def flush(self):
+        """Sends all buffered operations in one `_bulk` request"""
+        if not self.actions:
+            return
+
+        # Writes to an index that's being rebuilt go to its replacement as well
+        actions = list(with_build_targets(self.actions.values()))
+        refresh = self.refresh
+        self.clear()
+
+        es = connections.get_connection("default")
+        success, errors = bulk(es, actions, chunk_size=len(actions), refresh=refresh,
+                               raise_on_error=False)
+
+        # Deleting something that was never indexed is fine (see `Indexable.save(index=False)`),
+        # and so is a write to a new index that already has a newer version of the document
+        errors = [error for error in errors
+                  if not ("delete" in error and error["delete"].get("status") == 404) and
+                  list(error.values())[0].get("status") != 409]
+        if errors:
+            raise BulkIndexError("{} document(s) failed to index.".format(len(errors)), errors)
+
+
+@contextmanager
+def batch_indexing(using=None):
+    """Buffers all `Indexable` index and delete operations in this block.
+
+    The block runs inside `transaction.atomic()`. If it commits, all of the operations are flushed
+    as one `_bulk` request; if it rolls back, they are thrown away. When nested inside another
+    `batch_indexing()` block, the operations are handed to the outer block instead."""
+
+    stack = _get_stack()
+    buffer = IndexingBuffer()
+    stack.append(buffer)
+    try:
+        with transaction.atomic(using=using):
+            yield buffer
+    except Exception:
+        buffer.clear()
+        raise
+    finally:
+        stack.remove(buffer)
+
+    outer = get_current_buffer()
+    connection = db_connections[using or DEFAULT_DB_ALIAS]
+    if outer is not None:
+        outer.merge(buffer)
+    elif connection.in_atomic_block and hasattr(transaction, "on_commit"):
+        # We're in someone else's transaction, so wait until it actually commits
+        transaction.on_commit(lambda: _flush(buffer), using=using)
+    else:
+        _flush(buffer)
+
+
+def _flush(buffer):
+    from .conf import settings
+
+    if settings.DJES_WRITE_MODE == "async" and not buffer.refresh:
+        from .worker import get_worker
+
+        worker = get_worker()
+        for action in buffer.actions.values():
+            worker.put(action)
+        buffer.clear()
+    else:
+        buffer.flush()
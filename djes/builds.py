@@ -0,0 +1,79 @@
+import threading
+import time
+
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch_dsl.connections import connections
+
+from .conf import settings
+
+
+BUILD_ALIAS = "{}_build"
+
+# Documents that a build loads (from the database, or from the previous version of the index) are
+# written with this external version, and live writes and deletes get the time in milliseconds. So
+# a build never overwrites a live write, or brings back a document that was deleted while it ran
+BUILD_VERSION = 1
+
+_targets = {}
+_lock = threading.Lock()
+
+
+def get_build_alias(name):
+    """Returns the alias that points at the versioned index being built for an index alias"""
+    return BUILD_ALIAS.format(name)
+
+
+def get_build_targets(index):
+    """Returns the versioned indexes that are being built to replace an index alias.
+
+    Writes to the alias should go to these as well, so that nothing that changes while they're
+    loaded is missing when the alias moves. Lookups are cached for `DJES_BUILD_ALIAS_TTL` seconds;
+    setting that to `None` turns this off."""
+    from .apps import indexable_registry
+
+    ttl = settings.DJES_BUILD_ALIAS_TTL
+    if ttl is None or index not in indexable_registry.indexes:
+        return []
+
+    now = time.time()
+    with _lock:
+        cached = _targets.get(index)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    es = connections.get_connection("default")
+    try:
+        targets = sorted(es.indices.get_alias(name=get_build_alias(index)))
+    except NotFoundError:
+        targets = []
+
+    with _lock:
+        _targets[index] = (now + ttl, targets)
+    return targets
+
+
+def clear_build_targets():
+    """Forgets all cached build targets"""
+    with _lock:
+        _targets.clear()
+
+
+def get_live_version():
+    """Returns the external version for a live write or delete in an index that's being built.
+
+    Elasticsearch keeps deletes around for `index.gc_deletes` (see `DJES_BUILD_INDEX_SETTINGS`),
+    so a later write with `BUILD_VERSION` can't bring the document back."""
+    return int(time.time() * 1000)
+
+
+def with_build_targets(actions):
+    """Yields each bulk action, followed by a copy for each index being built to replace its
+    index"""
+    for action in actions:
+        yield action
+        for target in get_build_targets(action["_index"]):
+            copy = dict(action, _index=target)
+            # Partial updates can't be versioned, and only ever change documents that are there
+            if copy.get("_op_type", "index") != "update":
+                copy.update(_version=get_live_version(), _version_type="external_gte")
+            yield copy
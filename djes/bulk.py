@@ -0,0 +1,367 @@
+import threading
+import time
+from collections import Counter, deque
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
+
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import BulkIndexError, expand_action
+from elasticsearch_dsl.connections import connections
+
+from .builds import BUILD_VERSION, with_build_targets
+from .conf import settings
+from .serializers import get_related_lookups
+from .utils.query import batched_queryset, exact_model_filter, queryset_chunks
+
+
+def model_documents(model, queryset, chunksize=None, fields=None):
+    """Yields a `(pk, document)` pair for each object in `queryset`, with just the properties in
+    `fields`, if given.
+
+    If the model's mapping sets `from_values`, and can be built without model instances, documents
+    are built from `values_list()` rows. Otherwise, related objects that the mapping needs are
+    loaded with `select_related()` and `prefetch_related()`, one chunk at a time."""
+    mapping = model.search_objects.mapping
+    values_serializer = mapping.values_serializer
+    if values_serializer is not None and fields is not None:
+        values_serializer = values_serializer.only(fields)
+    if values_serializer is not None:
+        rows = values_serializer.values_list(queryset)
+        for chunk in queryset_chunks(rows, chunksize=chunksize, get_pk=itemgetter(0)):
+            for pk, document in values_serializer(chunk):
+                yield pk, document
+        return
+
+    serializer = mapping.serializer
+    select_related, prefetch_related = model.search_objects.related_lookups
+    if fields is not None:
+        serializer = serializer.only(fields)
+        select_related, prefetch_related = get_related_lookups(model, keys=fields)
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related:
+        queryset = queryset.prefetch_related(*prefetch_related)
+
+    for obj in batched_queryset(queryset, chunksize=chunksize):
+        yield obj.pk, serializer(obj)
+
+
+def model_iterator(model, index=None, out=None, queryset=None, chunksize=None,
+                   op_type="index", fields=None):
+    """Yields bulk actions for a model's objects (or those in `queryset`).
+
+    `op_type` can be "create" to leave documents that are already in the index alone (or that
+    were deleted since a build started; see `djes.builds.BUILD_VERSION`). With
+    `fields`, the actions are partial updates that only set those properties. Rows that belong to
+    multi-table inheritance children of the model are left out, since they're indexed with the
+    child's mapping."""
+    mapping = model.search_objects.mapping
+    if index is None:
+        index = mapping.index
+    if queryset is None:
+        queryset = model.objects.all()
+    queryset = queryset.filter(**exact_model_filter(model))
+
+    counter = 0
+    total = queryset.count()
+    if out:
+        out.write("Indexing {} {} objects".format(total, model.__name__))
+    for pk, document in model_documents(model, queryset, chunksize=chunksize, fields=fields):
+        counter += 1
+        if counter % 100 == 0:
+            if out:
+                out.write("Indexed {}/{} {} objects".format(counter, total, model.__name__))
+        if fields is not None:
+            yield {
+                "_op_type": "update",
+                "_id": pk,
+                "_index": index,
+                "_type": mapping.doc_type,
+                "doc": document
+            }
+            continue
+        action = {
+            "_op_type": op_type,
+            "_id": pk,
+            "_index": index,
+            "_type": mapping.doc_type,
+            "_source": document
+        }
+        if op_type == "create":
+            # Unlike a plain "create", this is rejected if the document was deleted
+            action.update(_op_type="index", _version=BUILD_VERSION, _version_type="external")
+        yield action
+
+
+class ChunkSizer(object):
+    """Works out how many actions to put in each bulk request, from how the cluster is coping.
+
+    Whenever Elasticsearch rejects actions (with a 429), the size is halved. Otherwise, if there's
+    a `target_latency` (in seconds), the size shrinks when requests take longer than that, and
+    grows (up to `maximum`) when they take less than half of it. Without one, the size grows back
+    towards where it started."""
+
+    def __init__(self, size, minimum=10, maximum=None, target_latency=None):
+        self.size = size
+        self.minimum = min(minimum, size)
+        self.maximum = maximum or size
+        self.target_latency = target_latency
+        self._lock = threading.Lock()
+
+    def record(self, latency, rejected=0):
+        """Records how long a bulk request took, and how many of its actions were rejected"""
+        with self._lock:
+            if rejected:
+                size = self.size // 2
+            elif self.target_latency is not None and latency > self.target_latency:
+                size = self.size * 3 // 4
+            elif self.target_latency is None or latency < self.target_latency / 2:
+                size = self.size * 5 // 4 + 1
+            else:
+                size = self.size
+            self.size = max(self.minimum, min(self.maximum, size))
+
+
+class TokenBucket(object):
+    """Limits something to `rate` units per second on average, allowing bursts of up to
+    `capacity` units (by default, one second's worth).
+
+    `consume()` can take more than the bucket holds, in which case it waits long enough to pay the
+    difference back."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Takes `amount` units from the bucket, sleeping if there weren't enough, and returns
+        how long it slept for"""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+def chunk_actions(es, actions, chunk_size=None, max_chunk_bytes=None, sizer=None):
+    """Serializes bulk actions, and groups them into chunks.
+
+    Each chunk has at most `chunk_size` actions (or `sizer.size`, as it stands when the chunk is
+    started) and `max_chunk_bytes` bytes (unless a single action is bigger than that), and is a
+    list of `(action, lines)` pairs."""
+    if chunk_size is None:
+        chunk_size = settings.DJES_BULK_CHUNK_SIZE
+    if max_chunk_bytes is None:
+        max_chunk_bytes = settings.DJES_BULK_MAX_CHUNK_BYTES
+
+    serializer = es.transport.serializer
+
+    chunk, size = [], 0
+    for action in actions:
+        op, data = expand_action(action)
+        lines = [serializer.dumps(op)]
+        if data is not None:
+            lines.append(serializer.dumps(data))
+        action_size = sum(len(line) + 1 for line in lines)
+
+        if chunk and (len(chunk) >= chunk_size or size + action_size > max_chunk_bytes):
+            yield chunk
+            chunk, size = [], 0
+
+        if not chunk and sizer is not None:
+            chunk_size = sizer.size
+
+        chunk.append((action, lines))
+        size += action_size
+
+    if chunk:
+        yield chunk
+
+
+def send_chunk(es, chunk, **kwargs):
+    """Sends one chunk in a `_bulk` request, and returns an `(ok, item)` pair for each action"""
+    body = "\n".join(line for action, lines in chunk for line in lines) + "\n"
+    response = es.bulk(body, **kwargs)
+
+    results = []
+    for item in response["items"]:
+        op_type, info = item.popitem()
+        results.append((200 <= info.get("status", 500) < 300, {op_type: info}))
+    return results
+
+
+def send_chunk_with_retries(es, chunk, sizer=None, max_retries=None, initial_backoff=None,
+                            max_backoff=None, **kwargs):
+    """Sends a chunk with `send_chunk()`, retrying the actions that Elasticsearch rejects (with a
+    429) after an exponential backoff, up to `max_retries` times.
+
+    Other failures aren't retried, since sending the same document again won't help. Returns an
+    `(ok, item)` pair for each action, in order."""
+    if max_retries is None:
+        max_retries = settings.DJES_BULK_MAX_RETRIES
+    if initial_backoff is None:
+        initial_backoff = settings.DJES_BULK_INITIAL_BACKOFF
+    if max_backoff is None:
+        max_backoff = settings.DJES_BULK_MAX_BACKOFF
+
+    results = [None] * len(chunk)
+    pending = list(range(len(chunk)))
+    for attempt in range(max_retries + 1):
+        retry = []
+        start = time.time()
+        try:
+            sent = send_chunk(es, [chunk[i] for i in pending], **kwargs)
+        except TransportError as e:
+            # The whole request was rejected
+            if e.status_code != 429 or attempt == max_retries:
+                raise
+            retry = pending
+        else:
+            for i, (ok, item) in zip(pending, sent):
+                if not ok and attempt < max_retries and list(item.values())[0].get("status") == 429:
+                    retry.append(i)
+                else:
+                    results[i] = (ok, item)
+
+        if sizer is not None:
+            sizer.record(time.time() - start, rejected=len(retry))
+        if not retry:
+            break
+        time.sleep(min(max_backoff, initial_backoff * 2 ** attempt))
+        pending = retry
+
+    return results
+
+
+def parallel_bulk(es, actions, thread_count=None, chunk_size=None, max_chunk_bytes=None,
+                  raise_on_error=True, max_retries=None, initial_backoff=None, max_backoff=None,
+                  target_latency=None, max_docs_per_sec=None, max_bytes_per_sec=None, **kwargs):
+    """Like `elasticsearch.helpers.streaming_bulk`, but keeps up to `thread_count` bulk requests
+    in flight at once.
+
+    Unlike `elasticsearch.helpers.parallel_bulk`, actions are only read as fast as the requests
+    complete, so no more than `thread_count + 2` chunks are ever held in memory. Results are
+    yielded in the same order as the actions. Rejected actions are retried (see
+    `send_chunk_with_retries()`), and the chunk size adapts to how the cluster is coping (see
+    `ChunkSizer`). `max_docs_per_sec` and `max_bytes_per_sec` hold chunks back, so that a
+    backfill doesn't crowd out other traffic."""
+    if thread_count is None:
+        thread_count = settings.DJES_BULK_CONCURRENCY
+    if chunk_size is None:
+        chunk_size = settings.DJES_BULK_CHUNK_SIZE
+    if target_latency is None:
+        target_latency = settings.DJES_BULK_TARGET_LATENCY
+    if max_docs_per_sec is None:
+        max_docs_per_sec = settings.DJES_BULK_MAX_DOCS_PER_SEC
+    if max_bytes_per_sec is None:
+        max_bytes_per_sec = settings.DJES_BULK_MAX_BYTES_PER_SEC
+
+    doc_bucket = TokenBucket(max_docs_per_sec) if max_docs_per_sec else None
+    byte_bucket = TokenBucket(max_bytes_per_sec) if max_bytes_per_sec else None
+
+    maximum = chunk_size * 10 if target_latency is not None else chunk_size
+    sizer = ChunkSizer(chunk_size, maximum=maximum, target_latency=target_latency)
+    kwargs.update(sizer=sizer, max_retries=max_retries, initial_backoff=initial_backoff,
+                  max_backoff=max_backoff)
+
+    pool = ThreadPool(thread_count)
+    pending = deque()
+
+    def results(request):
+        errors = []
+        for ok, item in request.get():
+            if not ok and raise_on_error:
+                errors.append(item)
+            yield ok, item
+        if errors:
+            raise BulkIndexError("{} document(s) failed to index.".format(len(errors)), errors)
+
+    try:
+        for chunk in chunk_actions(es, actions, chunk_size, max_chunk_bytes, sizer=sizer):
+            if doc_bucket is not None:
+                doc_bucket.consume(len(chunk))
+            if byte_bucket is not None:
+                byte_bucket.consume(sum(len(line) + 1 for action, lines in chunk for line in lines))
+            pending.append(pool.apply_async(send_chunk_with_retries, (es, chunk), kwargs))
+            # Once every thread is busy, wait for the oldest request before building another chunk
+            while len(pending) > thread_count:
+                for result in results(pending.popleft()):
+                    yield result
+
+        while pending:
+            for result in results(pending.popleft()):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def error_type(item):
+    """Returns the type of error for a failed bulk action"""
+    op_type, info = list(item.items())[0]
+    error = info.get("error")
+    if isinstance(error, dict):
+        return error.get("type", "unknown")
+    if error:
+        # Elasticsearch 1.x errors look like "MapperParsingException[failed to parse [foo]]"
+        return error.split("[", 1)[0]
+    return "status {}".format(info.get("status"))
+
+
+def summarize_errors(errors):
+    """Counts failed bulk actions by error type"""
+    return Counter(error_type(item) for item in errors)
+
+
+def acknowledged(ok, item):
+    """Returns `True` if a bulk action worked, or was a versioned write (or a "create") that lost
+    to a newer version of the document"""
+    op_type, info = list(item.items())[0]
+    return ok or (op_type != "update" and info.get("status") == 409)
+
+
+def index_model(model, es=None, index=None, queryset=None, out=None, progress=None,
+                op_type="index", fields=None, **kwargs):
+    """Indexes all of a model's objects (or those in `queryset`) with `parallel_bulk()`.
+
+    If given, `progress` is called with the id of each document as Elasticsearch acknowledges it,
+    up to the first failure. Since objects are indexed in primary key order, every object before
+    it has been acknowledged too. With an `op_type` of "create", documents that are already in
+    the index (because a live write got there first) are left alone, and count as indexed. With
+    `fields`, only those properties are sent, as partial updates, and objects that aren't in the
+    index are skipped. When writing to the model's live index, every action is sent to any new
+    version of it that's being built as well, in the same requests. Returns the number of
+    documents that were indexed (not counting those copies), and a list of errors."""
+    if es is None:
+        es = connections.get_connection("default")
+
+    # Results come back in the same order as the actions, so this says which ones are copies
+    copies = deque()
+
+    def actions():
+        for action in model_iterator(model, index=index, out=out, queryset=queryset,
+                                     op_type=op_type, fields=fields):
+            for number, copy in enumerate(with_build_targets([action])):
+                copies.append(number > 0)
+                yield copy
+
+    success, errors = 0, []
+    for ok, item in parallel_bulk(es, actions(), raise_on_error=False, **kwargs):
+        is_copy = copies.popleft()
+        info = list(item.values())[0]
+        if acknowledged(ok, item):
+            if not is_copy:
+                success += 1
+        elif not (fields is not None and info.get("status") == 404):
+            errors.append(item)
+        # Anything after a failure would be skipped when resuming, so progress stops there
+        if progress is not None and not errors and not is_copy:
+            progress(info.get("_id"))
+    return success, errors
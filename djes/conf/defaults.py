@@ -8,4 +8,79 @@ ES_CONNECTIONS = {
 ES_INDEX = _settings.DATABASES["default"]["NAME"]
 ES_INDEX_SETTINGS = {}
 
-DJES_EXCLUDED_MODELS = []
\ No newline at end of file
+DJES_EXCLUDED_MODELS = []
+
+# "sync" sends every write to Elasticsearch from the thread that saved the object, "async" hands it
+# to a background `djes.worker.IndexingWorker`, and "outbox" records it in the database, to be sent
+# by the `djes_worker` management command
+DJES_WRITE_MODE = "sync"
+DJES_ASYNC_QUEUE_SIZE = 10000
+DJES_ASYNC_THREADS = 1
+DJES_ASYNC_BATCH_SIZE = 500
+# What to do when the queue is full: "block", "drop", or "sync"
+DJES_ASYNC_FULL_POLICY = "block"
+
+# Number of rows to load per query when iterating over models (see `djes.utils.query`)
+DJES_QUERY_CHUNK_SIZE = 1000
+
+# Defaults for bulk indexing (see `djes.bulk.parallel_bulk`)
+DJES_BULK_CHUNK_SIZE = 500
+DJES_BULK_MAX_CHUNK_BYTES = 100 * 1024 * 1024
+DJES_BULK_CONCURRENCY = 1
+# Actions that Elasticsearch rejects (with a 429) are retried, backing off exponentially from
+# `DJES_BULK_INITIAL_BACKOFF` seconds
+DJES_BULK_MAX_RETRIES = 5
+DJES_BULK_INITIAL_BACKOFF = 2.0
+DJES_BULK_MAX_BACKOFF = 60.0
+# If set, bulk requests are made bigger or smaller to take about this many seconds each
+DJES_BULK_TARGET_LATENCY = None
+# Limits on how fast bulk indexing sends documents, per process
+DJES_BULK_MAX_DOCS_PER_SEC = None
+DJES_BULK_MAX_BYTES_PER_SEC = None
+# Where `bulk_index` and `sync_es` record their progress, so that a build can be resumed with
+# `bulk_index --resume`. Checkpoints are off unless this is set (preferably to an absolute path)
+DJES_BULK_CHECKPOINT_FILE = None
+
+# Index settings used while `sync_es` loads a new versioned index. They're put back to the ones in
+# `ES_INDEX_SETTINGS` (or Elasticsearch's defaults) once it's loaded
+DJES_BUILD_INDEX_SETTINGS = {
+    "index.number_of_replicas": 0,
+    "index.refresh_interval": "-1",
+    "index.translog.durability": "async",
+    # Deletes made while the index is built are remembered until it's done (see `djes.builds`)
+    "index.gc_deletes": "1d",
+}
+# If set, new versioned indexes are force merged down to this many segments once they're loaded
+DJES_BUILD_MAX_NUM_SEGMENTS = None
+# When a new versioned index replaces a live one, the alias isn't moved until its health is at
+# least this (or `DJES_BUILD_TIMEOUT` runs out). "green" also waits for replicas, which never comes
+# if they can't be allocated (e.g. on a single node)
+DJES_BUILD_WAIT_FOR_STATUS = "yellow"
+# Seconds to wait for force merges and health
+DJES_BUILD_TIMEOUT = 3600
+# If set, writes go to both the live index and the new versioned index while `sync_es` builds one
+# to replace it. Each process checks for builds at most this often (in seconds), and builds wait
+# this long before loading, so that every process is writing to the new index first
+DJES_BUILD_ALIAS_TTL = None
+# How `sync_es` loads a new versioned index: "database" serializes every object again, and
+# "reindex" copies the documents of each doc type whose fields haven't changed from the previous
+# version (so changes to `to_es()`, serializers or the data since it was indexed are missed). Copies
+# aren't recorded in checkpoints, and `bulk_index --resume` loads everything from the database
+DJES_BUILD_STRATEGY = "database"
+# How many slices the `_reindex` API splits a copy into (by default, `DJES_BULK_CONCURRENCY`)
+DJES_REINDEX_SLICES = None
+# Seconds between checks on a `_reindex` task
+DJES_REINDEX_POLL_INTERVAL = 5.0
+# How long each scroll is kept open, when documents are copied through this process
+DJES_REINDEX_SCROLL = "5m"
+
+# Page through results in `LazySearch.next()` with `search_after` (Elasticsearch 5 and up), rather
+# than from/size. The tiebreaker is added to the sort, so that every hit has a distinct position
+DJES_SEARCH_AFTER = False
+DJES_SEARCH_AFTER_TIEBREAKER = "_uid"
+# Defaults for `LazySearch.stream()`: results per scroll request, and how long to keep it open
+DJES_SCROLL_CHUNK_SIZE = 500
+DJES_SCROLL_TIMEOUT = "5m"
+# How many pages `LazySearch.next()` fetches ahead on a background thread (see
+# `LazySearch.prefetch()`). 0 turns this off
+DJES_SEARCH_PREFETCH_DEPTH = 0
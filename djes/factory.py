@@ -1,3 +1,5 @@
+import threading
+
 from django.db.backends import utils
 from django.db import models
 from django.db.models.fields.related import ManyToOneRel, ForeignObjectRel
@@ -59,48 +61,70 @@ class Test:
     attr = property(get, set)
 
 
+_shallow_classes = {}
+_shallow_classes_lock = threading.RLock()
+
+
 def shallow_class_factory(model):
+    """Returns the "_ElasticSearchResult" proxy class for a model, creating it if necessary.
+
+    The classes are cached for the life of the process (see `DJESConfig.ready()`, which creates them
+    all up front), so hydrating search results never needs the app registry."""
     if model._deferred:
         model = model._meta.proxy_for_model
-    name = "{}_ElasticSearchResult".format(model.__name__)
-    name = utils.truncate_name(name, 80, 32)
-    # try to get the model from the django registry
+
     try:
-        return apps.get_model(model._meta.app_label, name)
-    # get the object's type - hopefully a django model
-    except LookupError:
-        class Meta(object):
-            proxy = True
-            app_label = model._meta.app_label
-
-        class ElasticMapping:
-            class Meta:
-                elastic_abstract = True
-                doc_type = model.search_objects.mapping.doc_type
-
-        overrides = {
-            "save": None,
-            "Meta": Meta,
-            "Mapping": ElasticMapping,
-            "search_objects": model.search_objects.__class__(),
-            "__module__": model.__module__,
-            "_deferred": True,
-        }
-
-        for attname, es_field in iteritems(model.search_objects.mapping.properties._params["properties"]):
-            if type(es_field) == field.Nested:
-                # This is a nested object!
-                dj_field = model._meta.get_field(attname)
-
-                if isinstance(dj_field, ManyToOneRel):
-                    overrides[attname] = ElasticSearchManyField(attname, dj_field.related_model)
-                elif isinstance(dj_field, ForeignObjectRel):
-                    overrides[attname] = ElasticSearchForeignKey(attname, dj_field.related_model)
-
-                if isinstance(dj_field, models.ManyToManyField):
-                    overrides[attname] = ElasticSearchManyField(attname, dj_field.rel.to)
-
-                if isinstance(dj_field, models.ForeignKey):
-                    # Let's add a fake foreignkey attribute
-                    overrides[attname] = ElasticSearchForeignKey(attname, dj_field.rel.to)
-        return type(str(name), (model,), overrides)
+        return _shallow_classes[model]
+    except KeyError:
+        pass
+
+    # Building a class builds the classes for any nested models too, so this needs to be reentrant
+    with _shallow_classes_lock:
+        if model not in _shallow_classes:
+            name = "{}_ElasticSearchResult".format(model.__name__)
+            name = utils.truncate_name(name, 80, 32)
+            # try to get the model from the django registry
+            try:
+                _shallow_classes[model] = apps.get_model(model._meta.app_label, name)
+            # get the object's type - hopefully a django model
+            except LookupError:
+                _shallow_classes[model] = _build_shallow_class(model, name)
+        return _shallow_classes[model]
+
+
+def _build_shallow_class(model, name):
+    class Meta(object):
+        proxy = True
+        app_label = model._meta.app_label
+
+    class ElasticMapping:
+        class Meta:
+            elastic_abstract = True
+            doc_type = model.search_objects.mapping.doc_type
+
+    overrides = {
+        "save": None,
+        "Meta": Meta,
+        "Mapping": ElasticMapping,
+        "search_objects": model.search_objects.__class__(),
+        "__module__": model.__module__,
+        "_deferred": True,
+    }
+
+    for attname, es_field in iteritems(model.search_objects.mapping.properties._params["properties"]):
+        if type(es_field) == field.Nested:
+            # This is a nested object!
+            dj_field = model._meta.get_field(attname)
+
+            if isinstance(dj_field, ManyToOneRel):
+                overrides[attname] = ElasticSearchManyField(attname, dj_field.related_model)
+            elif isinstance(dj_field, ForeignObjectRel):
+                overrides[attname] = ElasticSearchForeignKey(attname, dj_field.related_model)
+
+            if isinstance(dj_field, models.ManyToManyField):
+                overrides[attname] = ElasticSearchManyField(attname, dj_field.rel.to)
+
+            if isinstance(dj_field, models.ForeignKey):
+                # Let's add a fake foreignkey attribute
+                overrides[attname] = ElasticSearchForeignKey(attname, dj_field.rel.to)
+    return type(str(name), (model,), overrides)
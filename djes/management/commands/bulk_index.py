@@ -1,75 +1,596 @@
-from django.core.management.base import BaseCommand
+import json
+import multiprocessing
+import os
+import re
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import partial
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections as db_connections
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from elasticsearch_dsl.connections import connections
-from elasticsearch.helpers import streaming_bulk
+import six
 
 from djes.apps import indexable_registry
+from djes.builds import get_build_alias
+from djes.bulk import index_model, model_iterator, summarize_errors  # noqa
 from djes.conf import settings
-from djes.utils.query import batched_queryset
+from djes.reindex import copy_documents
+
+
+# Settings used while (re)indexing into a live index
+LIVE_INDEX_SETTINGS = {"index.refresh_interval": "-1"}
+
+# What build settings go back to, if they're not in `ES_INDEX_SETTINGS`
+INDEX_SETTING_DEFAULTS = {
+    "index.number_of_replicas": 1,
+    "index.refresh_interval": "1s",
+    "index.translog.durability": "request",
+    "index.gc_deletes": "60s",
+}
+
+# Settings that older versions of Elasticsearch don't have, with the major version that added them
+INDEX_SETTING_VERSIONS = {
+    "index.translog.durability": 2,
+}
+
+DURATION_RE = re.compile(r"^(\d+)([smhdw])$")
+DURATION_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days", "w": "weeks"}
+
 
+def parse_since(value, now=None):
+    """Parses a `--since` value, which is either a duration ("30m", "1h", "2d"...) before now, or an
+    ISO 8601 date or datetime"""
+    match = DURATION_RE.match(value.strip())
+    if match:
+        if now is None:
+            now = timezone.now()
+        return now - timedelta(**{DURATION_UNITS[match.group(2)]: int(match.group(1))})
 
-def model_iterator(model, index=None, out=None):
-    if index is None:
-        index = model.search_objects.mapping.index
+    try:
+        since = parse_datetime(value)
+        if since is None:
+            date = parse_date(value)
+            if date is not None:
+                since = datetime.combine(date, datetime.min.time())
+    except ValueError:
+        since = None
+    if since is None:
+        raise CommandError("Can't parse \"{}\" as a duration or timestamp".format(value))
+
+    if settings.USE_TZ and timezone.is_naive(since):
+        since = timezone.make_aware(since, timezone.get_default_timezone())
+    return since
+
+
+def flatten_settings(data, prefix=""):
+    """Turns nested index settings into the flat, dotted form"""
+    flat = {}
+    for key, value in data.items():
+        if isinstance(value, dict):
+            flat.update(flatten_settings(value, "{}{}.".format(prefix, key)))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def apply_index_settings(es, index, index_settings):
+    """Applies temporary settings to an index while it's being loaded, and returns the settings to
+    put back afterwards.
+
+    Those come from `ES_INDEX_SETTINGS`, then `INDEX_SETTING_DEFAULTS`, then the index's current
+    settings. Settings that the cluster's version of Elasticsearch doesn't have are left out."""
+    major_version = int(es.info()["version"]["number"].split(".")[0])
+    index_settings = dict(
+        (key, value) for key, value in index_settings.items()
+        if INDEX_SETTING_VERSIONS.get(key, 0) <= major_version
+    )
+
+    configured = flatten_settings(settings.ES_INDEX_SETTINGS.get(index.rpartition("_")[0], {}))
+    current = es.indices.get_settings(index=index, flat_settings=True)[index]["settings"]
+
+    restore = {}
+    for key in index_settings:
+        for source in (configured, INDEX_SETTING_DEFAULTS, current):
+            if key in source:
+                restore[key] = source[key]
+                break
+
+    es.indices.put_settings(index=index, body=index_settings)
+    return restore
+
+
+def restore_index_settings(es, index, restore, max_num_segments=None):
+    """Makes a freshly loaded index searchable, optionally force merges it, and puts back the
+    settings that `apply_index_settings()` returned"""
+    es.indices.refresh(index=index)
+    if max_num_segments:
+        # This is much cheaper before the replicas come back. Newer clients call it `forcemerge()`
+        forcemerge = getattr(es.indices, "forcemerge", None) or es.indices.optimize
+        forcemerge(index=index, max_num_segments=max_num_segments,
+                   request_timeout=settings.DJES_BUILD_TIMEOUT)
+    if restore:
+        es.indices.put_settings(index=index, body=restore)
+
+
+def wait_for_health(es, index, out=None):
+    """Waits for an index to reach `DJES_BUILD_WAIT_FOR_STATUS`, so that the alias isn't pointed
+    at an index whose replicas aren't ready yet.
+
+    Returns whether it got there. If it doesn't within `DJES_BUILD_TIMEOUT`, this only warns, so
+    that the alias is still moved rather than leaving the new index without one."""
+    status = settings.DJES_BUILD_WAIT_FOR_STATUS
+    if not status:
+        return True
 
-    counter = 0
-    total = model.search_objects.count()
     if out:
-        out.write("Indexing {} {} objects".format(total, model.__name__))
-    for obj in batched_queryset(model.objects.all()):
-        if obj.__class__ != model:
-            # TODO: Come up with a better method to avoid redundant indexing
-            continue
-        counter += 1
-        if counter % 100 == 0:
+        out.write("Waiting for \"{}\" to be {}".format(index, status))
+    timeout = settings.DJES_BUILD_TIMEOUT
+    health = es.cluster.health(index=index, wait_for_status=status,
+                               timeout="{}s".format(timeout), request_timeout=timeout + 30)
+    if health.get("timed_out"):
+        if out:
+            out.write("Warning: \"{}\" is still {} after {} seconds".format(
+                index, health.get("status"), timeout))
+        return False
+    return True
+
+
+def changed_queryset(model, since=None, ids=None):
+    """Returns a model's objects that were modified since `since`, and/or whose primary keys are in
+    `ids`.
+
+    Changes are found with the `modified_field` set in the model's `Mapping.Meta`. If `since` is
+    given and the model doesn't have one, this returns `None`."""
+    queryset = model.objects.all()
+    if since is not None:
+        modified_field = getattr(model.search_objects.mapping.Meta, "modified_field", None)
+        if modified_field is None:
+            return None
+        queryset = queryset.filter(**{"{}__gte".format(modified_field): since})
+    if ids:
+        queryset = queryset.filter(pk__in=ids)
+    return queryset
+
+
+def get_pk_ranges(model, count):
+    """Splits a model's primary keys into (at most) `count` contiguous, inclusive ranges.
+
+    Only integer primary keys can be split; anything else comes back as a single open range."""
+    bounds = model.objects.aggregate(min=Min("pk"), max=Max("pk"))
+    if bounds["min"] is None:
+        return []
+    if not isinstance(bounds["min"], six.integer_types):
+        return [(None, None)]
+
+    step = max(1, -(-(bounds["max"] - bounds["min"] + 1) // count))
+    return [(start, min(start + step - 1, bounds["max"]))
+            for start in range(bounds["min"], bounds["max"] + 1, step)]
+
+
+def _init_worker():
+    """Runs in each worker process, so that it doesn't share connections with its parent"""
+    if not apps.ready:
+        django.setup()
+
+    db_connections.close_all()
+    for alias in list(settings.ES_CONNECTIONS):
+        try:
+            connections.remove_connection(alias)
+        except KeyError:
+            pass
+    connections.configure(**settings.ES_CONNECTIONS)
+
+
+class Checkpoint(object):
+    """Records how far bulk indexing has got in a JSON file, so that it can be resumed.
+
+    For each versioned index being built, this holds each model's primary key ranges, as
+    `[start, end, last_pk, done]` lists: `last_pk` is the last primary key in the range that
+    Elasticsearch has acknowledged. The file is written at most every `interval` seconds, except
+    when a range is done, and is removed once there's nothing left in it."""
+
+    def __init__(self, path, data=None, interval=5.0):
+        self.path = path
+        self.data = data if data is not None else {}
+        self.interval = interval
+        self._saved_at = 0.0
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except IOError:
+            data = None
+        return cls(path, data, **kwargs)
+
+    def start(self, index):
+        """Starts recording a build of `index`, forgetting any earlier progress"""
+        self.data[index] = {}
+        self.save()
+
+    def finish(self, index):
+        self.data.pop(index, None)
+        self.save()
+
+    def get_ranges(self, index, label):
+        return self.data.get(index, {}).get(label)
+
+    def set_ranges(self, index, label, ranges):
+        self.data.setdefault(index, {})[label] = [list(pk_range) for pk_range in ranges]
+        self.save()
+
+    def update(self, index, label, number, last_pk=None, done=False):
+        pk_range = self.data[index][label][number]
+        if last_pk is not None:
+            pk_range[2] = last_pk
+        if done:
+            pk_range[3] = True
+        self.save(force=done)
+
+    def save(self, force=True):
+        now = time.time()
+        if not force and now - self._saved_at < self.interval:
+            return
+        self._saved_at = now
+
+        if not self.data:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+
+        # Write a new file and move it into place, so that a crash can't leave half a checkpoint
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.data, f)
+        os.rename(temp_path, self.path)
+
+
+def report_failures(out, model, failures):
+    """Writes how many of a model's objects failed to index, broken down by error type"""
+    if not failures or not out:
+        return
+    out.write("{} {} objects failed to index".format(sum(failures.values()), model.__name__))
+    for error, count in failures.most_common():
+        out.write("    {}: {}".format(error, count))
+
+
+def range_queryset(model, start=None, end=None, last_pk=None):
+    """Returns a model's objects in an inclusive range of primary keys, after `last_pk`"""
+    queryset = model.objects.all()
+    if start is not None:
+        queryset = queryset.filter(pk__gte=start, pk__lte=end)
+    if last_pk is not None:
+        queryset = queryset.filter(pk__gt=last_pk)
+    return queryset
+
+
+def _index_pk_range(args):
+    label, index, number, start, end, last_pk, bulk_options = args
+    model = apps.get_model(label)
+
+    queryset = range_queryset(model, start, end, last_pk)
+    success, errors = index_model(model, index=index, queryset=queryset, **bulk_options)
+    return number, success + len(errors), summarize_errors(errors)
+
+
+def parallel_model_index(model, index, workers, out=None, checkpoint=None, **bulk_options):
+    """Indexes a model from several processes, each one handling a range of primary keys.
+
+    With a `checkpoint`, ranges that are done are skipped, and the others are started again."""
+    label = "{}.{}".format(model._meta.app_label, model._meta.object_name)
+    total = model.objects.count()
+
+    ranges = checkpoint.get_ranges(index, label) if checkpoint is not None else None
+    if ranges is None:
+        # More ranges than workers, so that one slow range doesn't hold everything up
+        ranges = [[start, end, None, False] for start, end in get_pk_ranges(model, workers * 4)]
+        if checkpoint is not None:
+            checkpoint.set_ranges(index, label, ranges)
+    if out:
+        out.write("Indexing {} {} objects in {} ranges, using {} processes".format(
+            total, model.__name__, len(ranges), workers))
+
+    # The rate limits are for the whole build, so split them between the workers
+    for option in ("max_docs_per_sec", "max_bytes_per_sec"):
+        if bulk_options.get(option):
+            bulk_options = dict(bulk_options, **{option: float(bulk_options[option]) / workers})
+
+    # Don't let the workers inherit our database connection
+    db_connections.close_all()
+
+    pool = multiprocessing.Pool(workers, initializer=_init_worker)
+    try:
+        counter = 0
+        failures = Counter()
+        tasks = [
+            (label, index, number, start, end, last_pk, bulk_options)
+            for number, (start, end, last_pk, done) in enumerate(ranges) if not done
+        ]
+        for number, count, range_failures in pool.imap_unordered(_index_pk_range, tasks):
+            counter += count
+            failures.update(range_failures)
+            # A range with failures is started again when resuming
+            if checkpoint is not None and not range_failures:
+                checkpoint.update(index, label, number, done=True)
             if out:
                 out.write("Indexed {}/{} {} objects".format(counter, total, model.__name__))
-        yield {
-            "_id": obj.pk,
-            "_index": index,
-            "_type": obj.mapping.doc_type,
-            "_source": obj.to_dict()
-        }
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    report_failures(out, model, failures)
+
+
+def model_index(es, model, index, out=None, checkpoint=None, **bulk_options):
+    """Indexes a model from this process, and returns a list of errors.
+
+    With a `checkpoint`, the last primary key acknowledged before any failure is recorded as
+    indexing goes, and indexing carries on from there."""
+    label = "{}.{}".format(model._meta.app_label, model._meta.object_name)
+
+    ranges = checkpoint.get_ranges(index, label) if checkpoint is not None else None
+    if ranges is None:
+        ranges = [[None, None, None, False]]
+        if checkpoint is not None:
+            checkpoint.set_ranges(index, label, ranges)
+
+    errors = []
+    for number, (start, end, last_pk, done) in enumerate(ranges):
+        if done:
+            continue
+        progress = None
+        if checkpoint is not None:
+            progress = partial(checkpoint.update, index, label, number)
+
+        queryset = range_queryset(model, start, end, last_pk)
+        success, range_errors = index_model(model, es=es, index=index, queryset=queryset, out=out,
+                                            progress=progress, **bulk_options)
+        errors.extend(range_errors)
+        if checkpoint is not None and not range_errors:
+            checkpoint.update(index, label, number, done=True)
+    return errors
+
+
+def copy_from_index(es, source, dest, doc_types, out=None, **bulk_options):
+    """Copies some doc types from another index with `djes.reindex.copy_documents()`, and reports
+    how it went"""
+    success, errors = copy_documents(es, source, dest, doc_types, out=out, **bulk_options)
+    if out:
+        out.write("Copied {} documents from \"{}\"".format(success, source))
+        failures = summarize_errors(errors)
+        if failures:
+            out.write("{} documents failed to copy".format(sum(failures.values())))
+            for error, count in failures.most_common():
+                out.write("    {}: {}".format(error, count))
+
 
+def bulk_index(es, index=None, version=1, out=None, workers=1, checkpoint=None, resume=False,
+               index_settings=None, max_num_segments=None, copy_from=None, copy_doc_types=(),
+               **bulk_options):
+    """Indexes every model in an index into a versioned index.
 
-def bulk_index(es, index=None, version=1, out=None):
+    `index_settings` are applied while the index is loaded (by default, just turning off
+    refreshes), and put back afterwards, when the index can also be force merged down to
+    `max_num_segments`. Doc types in `copy_doc_types` are copied from the `copy_from` index, and
+    only the other models are serialized. Progress is recorded in `checkpoint` (a `Checkpoint`),
+    if given. With `resume`, indexing picks up where the checkpoint says an earlier build of the
+    same versioned index stopped. Any `bulk_options` (`thread_count`, `chunk_size`,
+    `max_chunk_bytes`, `max_retries`, `target_latency`...) are passed on to
+    `djes.bulk.parallel_bulk()`."""
     index_base = index.rpartition('_')[0]
     # TODO: we need to reassess how we reference aliases and indices.
-    if index_base not in indexable_registry.indexes:
+    if index_base not in indexable_registry.indexes and not copy_doc_types:
         # Looks like someone is requesting the indexing of something we don't have models for
         return
 
     vindex = "{0}_{1:0>4}".format(index_base, version)
+    if checkpoint is not None and not (resume and vindex in checkpoint.data):
+        checkpoint.start(vindex)
 
-    es.indices.put_settings(
-        index=vindex,
-        body={"index": {"refresh_interval": "-1"}}
-    )
+    if index_settings is None:
+        index_settings = LIVE_INDEX_SETTINGS
+    restore = apply_index_settings(es, vindex, index_settings)
+
+    if copy_doc_types:
+        # Copies are always "create"s
+        copy_options = dict((key, value) for key, value in bulk_options.items() if key != "op_type")
+        copy_from_index(es, copy_from, vindex, list(copy_doc_types), out=out, **copy_options)
 
-    for model in indexable_registry.indexes[index_base]:
+    for model in indexable_registry.indexes.get(index_base, []):
 
         identifier = "{}.{}".format(model._meta.app_label, model._meta.object_name)
         if identifier in settings.DJES_EXCLUDED_MODELS:
             continue
+        if model.search_objects.mapping.doc_type in copy_doc_types:
+            continue
+
+        if workers > 1:
+            parallel_model_index(model, vindex, workers, out=out, checkpoint=checkpoint,
+                                 **bulk_options)
+        else:
+            errors = model_index(es, model, vindex, out=out, checkpoint=checkpoint,
+                                 **bulk_options)
+            report_failures(out, model, summarize_errors(errors))
+
+    restore_index_settings(es, vindex, restore, max_num_segments=max_num_segments)
+
+    if checkpoint is not None:
+        checkpoint.finish(vindex)
 
-        for ok, res in streaming_bulk(es, model_iterator(model, index=vindex, out=out)):
+
+def index_changes(es, models, since=None, ids=None, out=None, fields=None, **bulk_options):
+    """Indexes the objects that `changed_queryset()` finds into each model's live index (or alias),
+    rather than building a new versioned index.
+
+    With `fields`, only those properties are sent, as partial updates to the existing documents."""
+    for model in models:
+        queryset = changed_queryset(model, since=since, ids=ids)
+        if queryset is None:
+            if out:
+                out.write("Skipping {}, which has no modified_field".format(model.__name__))
             continue
 
-    es.indices.put_settings(
-        index=vindex,
-        body={"index": {"refresh_interval": "1"}}
-    )
+        success, errors = index_model(model, es=es, queryset=queryset, out=out, fields=fields,
+                                      **bulk_options)
+        report_failures(out, model, summarize_errors(errors))
 
 
 class Command(BaseCommand):
     help = "Creates ES indices, and ensures that mappings are up to date"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--since",
+                            help=("Only index objects modified since this timestamp, or this long "
+                                  "ago (30m, 1h, 2d...), into the live index"))
+        parser.add_argument("--model", action="append", default=[],
+                            help="Only index this model (app_label.ModelName) into the live index")
+        parser.add_argument("--ids",
+                            help="Only index these (comma-separated) primary keys of --model")
+        parser.add_argument("--fields",
+                            help=("Only send these (comma-separated) properties of --model, as "
+                                  "partial updates to the documents in the live index"))
+        parser.add_argument("--resume", action="store_true",
+                            help="Carry on with the builds recorded in the checkpoint file")
+        parser.add_argument("--checkpoint", default=settings.DJES_BULK_CHECKPOINT_FILE,
+                            help="File to record progress in (default: DJES_BULK_CHECKPOINT_FILE)")
+        parser.add_argument("--workers", type=int, default=1,
+                            help="Number of processes to index each model with")
+        parser.add_argument("--concurrency", type=int, default=settings.DJES_BULK_CONCURRENCY,
+                            help="Number of bulk requests each process keeps in flight")
+        parser.add_argument("--chunk-size", type=int, default=settings.DJES_BULK_CHUNK_SIZE,
+                            help="Maximum number of documents per bulk request")
+        parser.add_argument("--max-chunk-bytes", type=int,
+                            default=settings.DJES_BULK_MAX_CHUNK_BYTES,
+                            help="Maximum size of a bulk request, in bytes")
+        parser.add_argument("--max-retries", type=int, default=settings.DJES_BULK_MAX_RETRIES,
+                            help="Number of times to retry documents that Elasticsearch rejects")
+        parser.add_argument("--target-latency", type=float,
+                            default=settings.DJES_BULK_TARGET_LATENCY,
+                            help=("Seconds each bulk request should take; the chunk size is "
+                                  "adjusted to match"))
+        parser.add_argument("--max-docs-per-sec", type=float,
+                            default=settings.DJES_BULK_MAX_DOCS_PER_SEC,
+                            help="Maximum number of documents to send per second")
+        parser.add_argument("--max-bytes-per-sec", type=float,
+                            default=settings.DJES_BULK_MAX_BYTES_PER_SEC,
+                            help="Maximum number of bytes to send per second")
+
+    def get_models(self, labels):
+        if not labels:
+            return [
+                model for index in indexable_registry.indexes
+                for model in indexable_registry.indexes[index]
+                if "{}.{}".format(model._meta.app_label, model._meta.object_name) not in
+                settings.DJES_EXCLUDED_MODELS
+            ]
+
+        models = []
+        for label in labels:
+            try:
+                model = apps.get_model(label)
+            except (LookupError, ValueError):
+                raise CommandError("Unknown model \"{}\"".format(label))
+            if model not in indexable_registry.all_models.values():
+                raise CommandError("{} isn't an indexable model".format(label))
+            models.append(model)
+        return models
+
     def handle(self, *args, **options):
 
         es = connections.get_connection("default")
+        bulk_options = {
+            "thread_count": options["concurrency"],
+            "chunk_size": options["chunk_size"],
+            "max_chunk_bytes": options["max_chunk_bytes"],
+            "max_retries": options["max_retries"],
+            "target_latency": options["target_latency"],
+            "max_docs_per_sec": options["max_docs_per_sec"],
+            "max_bytes_per_sec": options["max_bytes_per_sec"],
+        }
+
+        if options["since"] or options["ids"] or options["model"] or options["fields"]:
+            models = self.get_models(options["model"])
+
+            fields = None
+            if options["fields"]:
+                if not options["model"]:
+                    raise CommandError("--fields needs --model")
+                fields = [key.strip() for key in options["fields"].split(",") if key.strip()]
+                for model in models:
+                    properties = model.search_objects.mapping.properties.properties
+                    unknown = [key for key in fields if key not in properties]
+                    if unknown:
+                        raise CommandError("{} isn't mapped with {}".format(
+                            model.__name__, ", ".join(unknown)))
+
+            ids = None
+            if options["ids"]:
+                if len(options["model"]) != 1:
+                    raise CommandError("--ids needs exactly one --model")
+                ids = [pk.strip() for pk in options["ids"].split(",") if pk.strip()]
+
+            since = None
+            if options["since"]:
+                since = parse_since(options["since"])
+
+            index_changes(es, models, since=since, ids=ids, out=self.stdout, fields=fields,
+                          **bulk_options)
+            return
+
+        checkpoint = None
+        if options["checkpoint"]:
+            checkpoint = Checkpoint.load(options["checkpoint"])
+        elif options["resume"]:
+            raise CommandError("--resume needs a checkpoint file")
+
         for index in list(indexable_registry.indexes):
 
             alias = es.indices.get_alias(index)
             index_name = list(alias)[0]
-            version = int(index_name.split("_")[-1])
 
-            bulk_index(es, index=index, version=version, out=self.stdout)
+            build_name = index_name
+            if options["resume"]:
+                builds = [name for name in checkpoint.data if name.rpartition("_")[0] == index]
+                if not builds:
+                    self.stdout.write("Nothing to resume for \"{}\"".format(index))
+                    continue
+                build_name = builds[0]
+                self.stdout.write("Resuming \"{}\"".format(build_name))
+
+            build_options = {}
+            if build_name != index_name:
+                # This is a new versioned index that `sync_es` didn't get to finish
+                build_options = {
+                    "op_type": "create",
+                    "index_settings": settings.DJES_BUILD_INDEX_SETTINGS,
+                    "max_num_segments": settings.DJES_BUILD_MAX_NUM_SEGMENTS,
+                }
+
+            version = int(build_name.split("_")[-1])
+            bulk_index(es, index=build_name, version=version, out=self.stdout,
+                       workers=options["workers"], checkpoint=checkpoint,
+                       resume=options["resume"], **dict(bulk_options, **build_options))
+
+            if build_name != index_name:
+                wait_for_health(es, build_name, out=self.stdout)
+                self.stdout.write("Pointing alias \"{}\" at versioned index \"{}\"".format(
+                    index, build_name))
+                actions = [
+                    {"remove": {"index": index_name, "alias": index}},
+                    {"add": {"index": build_name, "alias": index}},
+                ]
+                if es.indices.exists_alias(index=build_name, name=get_build_alias(index)):
+                    actions.append(
+                        {"remove": {"index": build_name, "alias": get_build_alias(index)}})
+                es.indices.update_aliases(body={"actions": actions})
@@ -0,0 +1,166 @@
+import time
+from collections import OrderedDict
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections as db_connections, transaction
+from elasticsearch.exceptions import TransportError
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch_dsl.connections import connections
+
+from djes.builds import with_build_targets
+from djes.models import IndexingOperation
+
+
+# Longest wait (in seconds) between attempts while Elasticsearch can't be reached
+MAX_BACKOFF = 60
+
+
+def merge_operations(operations):
+    """Returns the last operation for each object, keyed by model and object id"""
+    merged = OrderedDict()
+    for operation in operations:
+        key = (operation.model, operation.object_id)
+        merged.pop(key, None)
+        merged[key] = operation
+    return merged
+
+
+def get_actions(merged, using=None):
+    """Turns merged outbox operations into bulk actions.
+
+    Objects are loaded from the `using` database, with one `in_bulk()` per model. If an object to
+    be indexed no longer exists, it's deleted from the index instead."""
+    object_ids = OrderedDict()
+    for (label, object_id), operation in merged.items():
+        object_ids.setdefault(label, {})[object_id] = operation.op_type
+
+    for label, op_types in object_ids.items():
+        model = apps.get_model(label)
+        mapping = model.search_objects.mapping
+
+        index_ids = [object_id for object_id, op_type in op_types.items() if op_type == "index"]
+        objects = dict(
+            (str(pk), obj) for pk, obj in model.objects.using(using).in_bulk(index_ids).items()
+        )
+
+        for object_id, op_type in op_types.items():
+            obj = objects.get(object_id)
+            # Only index exact matches, so that a parent model doesn't overwrite a child document
+            if op_type == "index" and obj is not None and obj.__class__ == model:
+                yield (label, object_id), obj.to_bulk_action("index")
+            else:
+                yield (label, object_id), {
+                    "_op_type": "delete",
+                    "_index": mapping.index,
+                    "_type": mapping.doc_type,
+                    "_id": object_id
+                }
+
+
+def claim_operations(using, batch_size):
+    """Locks and returns the first `batch_size` rows of the outbox, inside a transaction.
+
+    Rows that another worker has locked are skipped with `SKIP LOCKED` where the database supports
+    it (on Django before 1.11, only PostgreSQL 9.5 and up). Elsewhere, workers wait for each other's
+    batches, so there's no point running more than one."""
+    queryset = IndexingOperation.objects.using(using).order_by("id")
+    connection = db_connections[using]
+
+    if getattr(connection.features, "has_select_for_update_skip_locked", False):
+        return list(queryset.select_for_update(skip_locked=True)[:batch_size])
+
+    if connection.vendor == "postgresql" and getattr(connection, "pg_version", 0) >= 90500:
+        # Older versions of Django can't ask for SKIP LOCKED themselves
+        sql = "SELECT * FROM {} ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED".format(
+            connection.ops.quote_name(IndexingOperation._meta.db_table))
+        return list(IndexingOperation.objects.db_manager(using).raw(sql, [batch_size]))
+
+    return list(queryset.select_for_update()[:batch_size])
+
+
+def drain_outbox(es, batch_size=500, using=None):
+    """Claims a batch of outbox operations from the `using` database, sends them to Elasticsearch,
+    and deletes them.
+
+    Operations that fail are put back at the end of the outbox to be retried. If Elasticsearch
+    can't be reached, the error is raised and the batch is left where it was. Returns the number
+    of rows claimed, and the number of failures."""
+    using = using or IndexingOperation.objects.db
+
+    with transaction.atomic(using=using):
+        operations = claim_operations(using, batch_size)
+        if not operations:
+            return 0, 0
+
+        merged = merge_operations(operations)
+        keys, actions = [], []
+        for key, action in get_actions(merged, using=using):
+            # If an index is being rebuilt, the operation goes to the new index too
+            for copy in with_build_targets([action]):
+                keys.append(key)
+                actions.append(copy)
+
+        failed = OrderedDict()
+        results = streaming_bulk(es, actions, chunk_size=batch_size, raise_on_error=False)
+        for key, (ok, result) in zip(keys, results):
+            op_type, item = list(result.items())[0]
+            # A 404 just means there was nothing to delete, and a 409 that a new index already
+            # has a newer version of the document
+            if ok or (op_type == "delete" and item.get("status") == 404):
+                continue
+            if item.get("status") != 409:
+                failed[key] = merged[key]
+
+        IndexingOperation.objects.using(using).filter(
+            id__in=[operation.id for operation in operations]).delete()
+        IndexingOperation.objects.using(using).bulk_create([
+            IndexingOperation(model=operation.model,
+                              object_id=operation.object_id,
+                              op_type=operation.op_type)
+            for operation in failed.values()
+        ])
+
+    return len(operations), len(failed)
+
+
+class Command(BaseCommand):
+    help = "Sends the index and delete operations in the outbox to Elasticsearch"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="Number of outbox rows to claim at a time")
+        parser.add_argument("--sleep", type=float, default=1.0,
+                            help="Seconds to wait when the outbox is empty")
+        parser.add_argument("--database", default=None,
+                            help="Database whose outbox to drain (default: \"default\")")
+        parser.add_argument("--once", action="store_true",
+                            help="Exit once the outbox is empty, or nothing more can be sent")
+
+    def handle(self, *args, **options):
+        es = connections.get_connection("default")
+
+        backoff = options["sleep"]
+        while True:
+            try:
+                claimed, failed = drain_outbox(es, batch_size=options["batch_size"],
+                                               using=options["database"])
+            except TransportError as e:
+                if options["once"]:
+                    raise
+                # The batch is still in the outbox, so try again, waiting longer each time
+                self.stderr.write("Couldn't send outbox operations ({}), retrying in {}s".format(
+                    e, backoff))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            backoff = options["sleep"]
+
+            if claimed:
+                self.stdout.write("Sent {} outbox operations ({} failed)".format(claimed, failed))
+            if claimed > failed:
+                continue
+
+            if options["once"]:
+                return
+            time.sleep(options["sleep"])
@@ -1,11 +1,17 @@
+import time
+
 from django.core.management.base import BaseCommand
 from django.utils.encoding import smart_text
 from elasticsearch import TransportError
 from elasticsearch_dsl.connections import connections
 
 from djes.apps import indexable_registry
+from djes.builds import get_build_alias
 from djes.conf import settings
-from djes.management.commands.bulk_index import bulk_index
+from djes.management.commands.bulk_index import (
+    Checkpoint, bulk_index, index_changes, wait_for_health
+)
+from djes.reindex import needs_serializing, new_properties
 
 import copy
 
@@ -54,8 +60,43 @@ def build_versioned_index(name, version=1, body=None, old_version=None, should_i
     if out:
         out.write("Creating versioned index \"{}\"".format(versioned_index_name))
 
+    # While the new index is loaded, live writes go to it as well as the old one
+    build_alias = None
+    if old_version is not None and settings.DJES_BUILD_ALIAS_TTL is not None:
+        build_alias = get_build_alias(name)
+        es.indices.put_alias(index=versioned_index_name, name=build_alias)
+        if should_index:
+            if out:
+                out.write("Waiting {}s for every process to start writing to \"{}\"".format(
+                    settings.DJES_BUILD_ALIAS_TTL, versioned_index_name))
+            time.sleep(settings.DJES_BUILD_ALIAS_TTL)
+
     if should_index:
-        bulk_index(es, index=versioned_index_name, version=version, out=out)  # Bulk index here...
+        copy_from, copy_doc_types = None, []
+        if old_version is not None and settings.DJES_BUILD_STRATEGY == "reindex":
+            # Doc types whose fields haven't changed (even if their types or analyzers have) are
+            # copied from the old index, and only the others are serialized again
+            copy_from = "{0}_{1:0>4}".format(name, old_version)
+            old_mappings = es.indices.get_mapping(index=copy_from)[copy_from]["mappings"]
+            changed = needs_serializing(old_mappings, body["mappings"])
+            copy_doc_types = [doc_type for doc_type in sorted(body["mappings"])
+                              if doc_type not in changed]
+            if changed and out:
+                out.write("Indexing {} from the database".format(", ".join(changed)))
+
+        checkpoint = None
+        if settings.DJES_BULK_CHECKPOINT_FILE:
+            # If this gets interrupted, `bulk_index --resume` can finish it off
+            checkpoint = Checkpoint.load(settings.DJES_BULK_CHECKPOINT_FILE)
+        bulk_index(es, index=versioned_index_name, version=version, out=out,
+                   checkpoint=checkpoint, op_type="create",
+                   copy_from=copy_from, copy_doc_types=copy_doc_types,
+                   index_settings=settings.DJES_BUILD_INDEX_SETTINGS,
+                   max_num_segments=settings.DJES_BUILD_MAX_NUM_SEGMENTS)  # Bulk index here...
+
+    if should_index and old_version is not None:
+        # Don't send the old index's traffic to the new one until its replicas are ready
+        wait_for_health(es, versioned_index_name, out=out)
 
     if out:
         out.write("Pointing alias \"{}\" at versioned index \"{}\"".format(name, versioned_index_name))
@@ -64,6 +105,9 @@ def build_versioned_index(name, version=1, body=None, old_version=None, should_i
     if old_version is not None:
         old_versioned_index_name = "{0}_{1:0>4}".format(name, old_version)
         actions.insert(0, {"remove": {"index": old_versioned_index_name, "alias": name}})
+    if build_alias is not None:
+        # Both aliases move at once, so no write can miss the new index
+        actions.append({"remove": {"index": versioned_index_name, "alias": build_alias}})
 
     es.indices.update_aliases(body={"actions": actions})
 
@@ -81,7 +125,36 @@ def stringify(data):
     return data
 
 
-def sync_index(name, body, should_index=False, out=None):
+def backfill_properties(es, name, backfills, backfill=False, out=None):
+    """Fills in properties that have been added to the mappings of a live index, by sending just
+    those properties as partial updates to every document.
+
+    `backfills` maps each doc type to its new properties. Unless `backfill` is set, this only says
+    how to do it later."""
+    models = dict(
+        (model.search_objects.mapping.doc_type, model)
+        for model in indexable_registry.indexes.get(name, [])
+    )
+    for doc_type, keys in sorted(backfills.items()):
+        model = models.get(doc_type)
+        if model is None:
+            continue
+        identifier = "{}.{}".format(model._meta.app_label, model._meta.object_name)
+        if identifier in settings.DJES_EXCLUDED_MODELS:
+            continue
+
+        if backfill:
+            if out:
+                out.write("Backfilling {} in \"{}\"".format(", ".join(keys), doc_type))
+            index_changes(es, [model], out=out, fields=keys)
+        elif out:
+            out.write("Existing \"{}\" documents don't have {} yet. To add them, run:".format(
+                doc_type, ", ".join(keys)))
+            out.write("    python manage.py bulk_index --model {} --fields {}".format(
+                identifier, ",".join(keys)))
+
+
+def sync_index(name, body, should_index=False, out=None, backfill=False):
     es = connections.get_connection("default")
     version = get_latest_index_version(name)
 
@@ -144,6 +217,8 @@ def sync_index(name, body, should_index=False, out=None):
 
     server_mappings = es.indices.get_mapping(index=index_name)[index_name]["mappings"]
 
+    # Properties that are added to existing doc types, by doc type
+    backfills = {}
     for doc_type, mapping_body in body["mappings"].items():
         if mapping_body != server_mappings.get(doc_type, {}):
             try:
@@ -164,21 +239,37 @@ def sync_index(name, body, should_index=False, out=None):
                     build_versioned_index(
                         name,
                         should_index=should_index,
+                        out=out,
                         version=new_version,
                         body=body,
                         old_version=old_version
                     )
-                    break
+                    # Everything is indexed into the new index, so there's nothing to backfill
+                    return
                 else:
                     raise e
+            else:
+                if doc_type in server_mappings:
+                    keys = new_properties(server_mappings[doc_type], mapping_body)
+                    if keys:
+                        backfills[doc_type] = keys
+
+    if backfills and should_index:
+        backfill_properties(es, name, backfills, backfill=backfill, out=out)
 
 
 class Command(BaseCommand):
     help = "Creates ES indices, and ensures that mappings are up to date"
 
+    def add_arguments(self, parser):
+        parser.add_argument("--backfill", action="store_true",
+                            help=("Send properties that have been added to a mapping to the "
+                                  "existing documents, as partial updates"))
+
     def handle(self, *args, **options):
 
         indexes = get_indexes()
 
         for index, body in indexes.items():
-            sync_index(index, body, should_index=True, out=self.stdout)
+            sync_index(index, body, should_index=True, out=self.stdout,
+                       backfill=options["backfill"])
@@ -5,6 +5,7 @@ from elasticsearch_dsl.mapping import Mapping
 from elasticsearch_dsl.field import Field
 
 from djes.conf import settings
+from djes.serializers import Serializer, ValuesSerializer
 
 FIELD_MAPPINGS = {
     "AutoField": {"type": "long"},
@@ -110,6 +111,12 @@ class DjangoMapping(Mapping):
         if getattr(self.Meta, "dynamic", "strict") == "strict":
             self.properties._params["dynamic"] = "strict"
 
+        # Work out how to serialize each property once, rather than for every object
+        self.serializer = Serializer.compile(self)
+        self.values_serializer = None
+        if getattr(self.Meta, "from_values", False):
+            self.values_serializer = ValuesSerializer.compile(self)
+
 
     def configure_field(self, field):
         """This configures an Elasticsearch Mapping field, based on a Django model field"""
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexingOperation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False,
+                                        auto_created=True)),
+                ('model', models.CharField(max_length=255)),
+                ('object_id', models.CharField(max_length=255)),
+                ('op_type', models.CharField(max_length=6,
+                                             choices=[('index', 'Index'), ('delete', 'Delete')])),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
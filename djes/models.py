@@ -3,9 +3,13 @@ from elasticsearch.exceptions import NotFoundError
 from elasticsearch_dsl.connections import connections
 
 from .apps import indexable_registry
-from .factory import shallow_class_factory
+from .bulk import index_model
+from .buffer import get_current_buffer
+from .builds import get_build_targets, get_live_version
+from .conf import settings
 from .mapping import DjangoMapping, get_first_mapping
 from .search import LazySearch
+from .serializers import Hydrator, get_related_lookups
 
 
 class IndexableManager(models.Manager):
@@ -37,39 +41,36 @@ class IndexableManager(models.Manager):
             self._mapping = mapping_klass(self.model)
         return self._mapping
 
-    def from_es(self, hit):
-        """Returns a Django model instance, using a document from Elasticsearch"""
-        doc = hit.copy()
-        klass = shallow_class_factory(self.model)
-
-        # We can pass in the entire source, except when we have a non-indexable many-to-many
-        for field in self.model._meta.get_fields():
-
-            if not field.auto_created and field.many_to_many:
-                if not issubclass(field.rel.to, Indexable):
-                    if field.name in doc["_source"]:
-                        del doc["_source"][field.name]
+    @property
+    def hydrator(self):
+        """Get a compiled plan for turning Elasticsearch hits into shallow model instances
 
-            # if field.one_to_many:
-            #     if field.name in doc["_source"]:
-            #         del doc["_source"][field.name]
+        This is built from the model's mapping, and cached on the manager."""
+        if not hasattr(self, "_hydrator"):
+            self._hydrator = Hydrator.compile(self.model, self.mapping)
+        return self._hydrator
 
-        # Now let's go ahead and parse all the fields
-        fields = self.mapping.properties.properties
-        for key in fields:
-            # TODO: What if we've mapped the property to a different name? Will we allow that?
-            field = fields[key]
+    @property
+    def related_lookups(self):
+        """Get the `select_related()` and `prefetch_related()` lookups needed to serialize objects
 
-            # if isinstance(field, InnerObject):
-            #     import pdb; pdb.set_trace()
-            #     continue
+        These are worked out from the mapping (including nested objects), and cached on the
+        manager."""
+        if not hasattr(self, "_related_lookups"):
+            self._related_lookups = get_related_lookups(self.model)
+        return self._related_lookups
 
-            if doc["_source"].get(key):
-                attribute_value = doc["_source"][key]
+    def bulk_index(self, queryset=None, index=None, **kwargs):
+        """Indexes all of this model's objects (or those in `queryset`) with bulk requests
 
-                doc["_source"][key] = field.to_python(attribute_value)
+        Related objects are loaded a chunk at a time, so each chunk costs the same number of
+        queries however many objects it holds. Returns the number of documents that were indexed,
+        and a list of errors."""
+        return index_model(self.model, queryset=queryset, index=index, **kwargs)
 
-        return klass(**doc["_source"])
+    def from_es(self, hit):
+        """Returns a Django model instance, using a document from Elasticsearch"""
+        return self.hydrator(hit)
 
     def get(self, **kwargs):
         """Get a object from Elasticsearch by id
@@ -146,58 +147,81 @@ class Indexable(models.Model):
 
     def to_dict(self):
         """Get a dictionary representation of this item, formatted for Elasticsearch"""
-        out = {}
-
-        fields = self.__class__.search_objects.mapping.properties.properties
-
-        for key in fields:
-            # TODO: What if we've mapped the property to a different name? Will we allow that?
-
-            attribute = getattr(self, key)
-
-            field = fields[key]
-
-            # I believe this should take the highest priority.
-            if hasattr(field, "to_es"):
-                out[key] = field.to_es(attribute)
-
-            # First we check it this is a manager, in which case we have many related objects
-            elif isinstance(attribute, models.Manager):
-                if issubclass(attribute.model, Indexable):
-                    # TODO: We want this to have some awareness of the relevant field.
-                    out[key] = [obj.to_dict() for obj in attribute.all()]
-                else:
-                    out[key] = list(attribute.values_list("pk", flat=True))
-
-            elif callable(attribute):
-                out[key] = attribute()
-
-            elif isinstance(attribute, Indexable):
-                out[key] = attribute.to_dict()
-            else:
-                out[key] = attribute
-
-            if out[key] is None:
-                del out[key]
-        return out
+        return self.__class__.search_objects.mapping.serializer(self)
 
     def index(self, refresh=False):
         """Indexes this object, using a document from `to_dict()`"""
+        if self._defer_write("index", refresh=refresh):
+            return
+
         es = connections.get_connection("default")
         index = self.__class__.search_objects.mapping.index
         doc_type = self.__class__.search_objects.mapping.doc_type
+        body = self.to_dict()
         es.index(index, doc_type,
                  id=self.pk,
-                 body=self.to_dict(),
+                 body=body,
                  refresh=refresh)
 
+        for target in get_build_targets(index):
+            # A conflict means a newer version of the document is already there
+            es.index(target, doc_type, id=self.pk, body=body, refresh=refresh,
+                     version=get_live_version(), version_type="external_gte", ignore=[409])
+
     def delete_index(self, refresh=False, ignore=None):
         """Removes the object from the index if `indexed=False`"""
+        if self._defer_write("delete", refresh=refresh):
+            return
+
         es = connections.get_connection("default")
         index = self.__class__.search_objects.mapping.index
         doc_type = self.__class__.search_objects.mapping.doc_type
         es.delete(index, doc_type, id=self.pk, refresh=refresh, ignore=ignore)
 
+        for target in get_build_targets(index):
+            # The object might not have been loaded into the new index yet, but the versioned
+            # delete stops the build from loading it afterwards
+            es.delete(target, doc_type, id=self.pk, refresh=refresh,
+                      version=get_live_version(), version_type="external_gte", ignore=[404, 409])
+
+    def to_bulk_action(self, op_type="index"):
+        """Returns a `_bulk` action for this object, as used by `elasticsearch.helpers.bulk`"""
+        action = {
+            "_op_type": op_type,
+            "_index": self.mapping.index,
+            "_type": self.mapping.doc_type,
+            "_id": self.pk
+        }
+        if op_type != "delete":
+            action["_source"] = self.to_dict()
+        return action
+
+    def _defer_write(self, op_type, refresh=False):
+        """Hands a write to the active `batch_indexing()` block or the background worker.
+
+        Returns `False` if the write should be sent right away."""
+        if settings.DJES_WRITE_MODE == "outbox" and not refresh:
+            # The row goes in the same database (and so the same transaction) as the change
+            IndexingOperation.objects.db_manager(self._state.db).create(
+                model="{}.{}".format(self._meta.app_label, self._meta.object_name),
+                object_id=self.pk,
+                op_type=op_type
+            )
+            return True
+
+        buffer = get_current_buffer()
+        if buffer is not None:
+            buffer.add(self.to_bulk_action(op_type), refresh=refresh)
+            return True
+
+        # Callers that ask for a refresh expect to be able to search for the object right away
+        if settings.DJES_WRITE_MODE == "async" and not refresh:
+            from .worker import get_worker
+            get_worker().put(self.to_bulk_action(op_type))
+            return True
+
+        return False
+
     @property
     def mapping(self):
         """Returns the proper mapping for this instance"""
@@ -240,3 +264,20 @@ class Indexable(models.Model):
         for subclass in cls.__subclasses__():
             names += subclass.get_doc_types()
         return names
+
+
+class IndexingOperation(models.Model):
+    """A pending index or delete for an `Indexable` object, used by the "outbox" write mode.
+
+    These are written in the same transaction as the change that caused them, and sent to
+    Elasticsearch by the `djes_worker` management command."""
+
+    OP_TYPE_CHOICES = (
+        ("index", "Index"),
+        ("delete", "Delete"),
+    )
+
+    model = models.CharField(max_length=255)
+    object_id = models.CharField(max_length=255)
+    op_type = models.CharField(max_length=6, choices=OP_TYPE_CHOICES)
+    created = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,143 @@
+import time
+from multiprocessing.pool import ThreadPool
+
+from elasticsearch.helpers import scan
+
+from .builds import BUILD_VERSION
+from .bulk import acknowledged, parallel_bulk
+from .conf import settings
+
+
+def get_server_version(es):
+    """Returns the cluster's Elasticsearch version, as a `(major, minor)` tuple"""
+    number = es.info()["version"]["number"]
+    return tuple(int(part) for part in number.split("-")[0].split(".")[:2])
+
+
+def document_fields(mapping, prefix=""):
+    """Returns the dotted paths of every field in a doc type's mapping, including the fields of
+    objects and nested objects"""
+    fields = set()
+    for key, value in mapping.get("properties", {}).items():
+        fields.add(prefix + key)
+        fields.update(document_fields(value, prefix + key + "."))
+    return fields
+
+
+def new_properties(old_mapping, new_mapping):
+    """Returns the top-level properties of a doc type's mapping that are new, or have gained fields
+    (in objects or nested objects), so existing documents don't have them"""
+    old_properties = old_mapping.get("properties", {})
+    return sorted(
+        key for key, value in new_mapping.get("properties", {}).items()
+        if key not in old_properties or
+        document_fields(old_properties[key]) != document_fields(value)
+    )
+
+
+def needs_serializing(old_mappings, new_mappings):
+    """Returns the doc types in `new_mappings` whose documents can't be copied from an index with
+    `old_mappings`, because they're new, or their fields have changed (so `_source` is missing
+    something that only Django knows)"""
+    return sorted(
+        doc_type for doc_type, mapping in new_mappings.items()
+        if doc_type not in old_mappings or
+        document_fields(old_mappings[doc_type]) != document_fields(mapping)
+    )
+
+
+def reindex_task(es, source, dest, doc_types, out=None, slices=None, poll_interval=None):
+    """Copies documents with the `_reindex` API, and polls the task until it's done.
+
+    Documents that are already in `dest` (or were deleted from it) are left alone. Returns the
+    number of documents copied, and a list of failures."""
+    if slices is None:
+        slices = settings.DJES_REINDEX_SLICES or settings.DJES_BULK_CONCURRENCY
+    if poll_interval is None:
+        poll_interval = settings.DJES_REINDEX_POLL_INTERVAL
+
+    body = {
+        "conflicts": "proceed",
+        "source": {"index": source, "type": doc_types, "size": settings.DJES_BULK_CHUNK_SIZE},
+        # Source versions are counts of writes, so live writes (see `djes.builds`) always win
+        "dest": {"index": dest, "version_type": "external"},
+    }
+    task_id = es.reindex(body=body, wait_for_completion=False, slices=slices)["task"]
+
+    while True:
+        task = es.tasks.get(task_id=task_id)
+        if task.get("completed"):
+            break
+        if out:
+            status = task["task"]["status"]
+            out.write("Copied {}/{} documents".format(
+                status["created"] + status["version_conflicts"], status["total"]))
+        time.sleep(poll_interval)
+
+    response = task.get("response", {})
+    failures = list(response.get("failures", []))
+    if "error" in task:
+        failures.append(task["error"])
+    return response.get("created", 0) + response.get("version_conflicts", 0), failures
+
+
+def copy_doc_type(es, source, dest, doc_type, **bulk_options):
+    """Copies one doc type's documents by scrolling through `source` and bulk indexing them into
+    `dest` from this process.
+
+    Documents that are already in `dest` (or were deleted from it) are left alone. Returns the
+    number of documents copied, and a list of errors."""
+    hits = scan(es, index=source, doc_type=doc_type, scroll=settings.DJES_REINDEX_SCROLL,
+                size=bulk_options.get("chunk_size") or settings.DJES_BULK_CHUNK_SIZE)
+    actions = (
+        {
+            "_op_type": "index",
+            "_index": dest,
+            "_type": hit["_type"],
+            "_id": hit["_id"],
+            "_source": hit["_source"],
+            "_version": BUILD_VERSION,
+            "_version_type": "external",
+        }
+        for hit in hits
+    )
+
+    success, errors = 0, []
+    for ok, item in parallel_bulk(es, actions, raise_on_error=False, **bulk_options):
+        if acknowledged(ok, item):
+            success += 1
+        else:
+            errors.append(item)
+    return success, errors
+
+
+def copy_documents(es, source, dest, doc_types, out=None, **bulk_options):
+    """Copies the documents of some doc types from one index to another, without going back to the
+    database.
+
+    If the client and cluster support the `_reindex` API, Elasticsearch does the copying itself,
+    split into slices. Otherwise, each doc type is scrolled and bulk indexed from a thread in this
+    process. Returns the number of documents copied, and a list of errors."""
+    if hasattr(es, "reindex") and get_server_version(es) >= (5, 0):
+        if out:
+            out.write("Reindexing {} from \"{}\" into \"{}\"".format(
+                ", ".join(doc_types), source, dest))
+        return reindex_task(es, source, dest, doc_types, out=out)
+
+    def copy(doc_type):
+        if out:
+            out.write("Copying {} documents from \"{}\" into \"{}\"".format(doc_type, source, dest))
+        return copy_doc_type(es, source, dest, doc_type, **bulk_options)
+
+    pool = ThreadPool(max(1, min(len(doc_types), settings.DJES_BULK_CONCURRENCY)))
+    try:
+        results = pool.map(copy, doc_types)
+    finally:
+        pool.close()
+        pool.join()
+
+    success, errors = 0, []
+    for doc_type_success, doc_type_errors in results:
+        success += doc_type_success
+        errors.extend(doc_type_errors)
+    return success, errors
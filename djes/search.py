@@ -1,8 +1,83 @@
+import threading
+
 from elasticsearch_dsl.connections import connections
 from elasticsearch_dsl.result import Response
 from elasticsearch_dsl import Search
+import six
+from six.moves import queue
 
 from .apps import indexable_registry
+from .conf import settings
+
+
+_DONE = object()
+
+
+def read_ahead(iterator, depth):
+    """Yields the items of `iterator`, while a background thread gets ahead of the caller.
+
+    Up to `depth` items wait to be used, while the thread gets the next one. Errors are raised
+    where the item would have been. If the generator is closed (or garbage collected) early, the
+    thread stops once it's done with the item it's on, so `iterator` shouldn't hold on to anything
+    that holds on to this generator."""
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def run():
+        try:
+            for item in iterator:
+                items.put((item, None))
+                if stopped.is_set():
+                    return
+            items.put((_DONE, None))
+        except Exception as e:
+            items.put((None, e))
+
+    thread = threading.Thread(target=run, name="djes-read-ahead")
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        stopped.set()
+        # Make room, in case the thread is waiting to put something
+        while True:
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                break
+
+
+def page_responses(es, body, size, start=0, search_after=False, **search_kwargs):
+    """Yields the raw search response for each page of `size` hits, starting at `start`.
+
+    With `search_after`, each page carries on from the sort values of the last hit on the previous
+    one (so `body` needs a sort that's stable), and `start` is ignored. Otherwise, pages are fetched
+    with from/size, which gets slower the deeper it goes."""
+    from_, after = start, None
+    while True:
+        page = dict(body, size=size)
+        if not search_after:
+            page["from"] = from_
+        elif after is not None:
+            page["search_after"] = after
+
+        response = es.search(body=page, **search_kwargs)
+        yield response
+
+        hits = response["hits"]["hits"]
+        if len(hits) < size:
+            # A short page is the last one
+            return
+        from_ += len(hits)
+        after = hits[-1].get("sort")
 
 
 class ShallowResponse(Response):
@@ -57,41 +132,198 @@ class LazySearch(Search):
     def __init__(self, *args, **kwargs):
         super(LazySearch, self).__init__(*args, **kwargs)
         self.position = kwargs.get("from", 0)
-        self._results = []
+        # Only the current page of `next()` is kept, starting at `_page_start`
+        self._page = []
+        self._page_start = self.position
+        self._pages = None
 
     def __len__(self):
-        if 'size' in self._extra:
-            return min(self._extra['size'], self.count())
+        if "size" in self._extra:
+            # Only the results up to the end of the slice need counting
+            start = self._extra.get("from", 0)
+            return max(self.count(cap=start + self._extra["size"]) - start, 0)
         return self.count()
 
+    def __bool__(self):
+        # Like `len()`, only whether there are results past the start of the slice
+        start = self._extra.get("from", 0)
+        return self._extra.get("size") != 0 and self.count(cap=start + 1) > start
+
+    __nonzero__ = __bool__
+
+    def count(self, cap=None):
+        """Returns the number of documents matching the query, ignoring any slice.
+
+        If the search has been executed, its total is used. Otherwise a `size=0` search is sent, and
+        the count is cached on this search. With `cap`, each shard stops counting after `cap`
+        matches (`terminate_after`), and `min(count, cap)` is returned, which is much cheaper
+        than an exact count over a large index (e.g. to show "10,000+ results"). A capped count
+        that reaches its cap is cached as a lower bound, which answers later counts with a cap
+        up to it (and `exists()`)."""
+        if hasattr(self, "_executed"):
+            # Not `hits.total`, which would load every hit of a `full()` search from the database
+            total = self._executed._d_["hits"]["total"]
+        elif hasattr(self, "_count"):
+            total = self._count
+        elif cap is not None and cap <= getattr(self, "_count_at_least", 0):
+            total = cap
+        else:
+            params = dict(self._params)
+            if cap is not None:
+                params["terminate_after"] = cap
+            es = connections.get_connection(self._using)
+            response = es.search(index=self._index, doc_type=self._doc_type,
+                                 body=self.to_dict(count=True, size=0), **params)
+            total = response["hits"]["total"]
+            # Under the cap, a capped count is exact too
+            if cap is None or total < cap:
+                self._count = total
+            else:
+                self._count_at_least = cap
+
+        if cap is not None:
+            return min(total, cap)
+        return total
+
+    def exists(self):
+        """Returns whether any document matches the query, stopping at the first match"""
+        return self.count(cap=1) > 0
+
     def __next__(self):
         return self.next()
 
     def next(self):
         # Tracks index on the search object so we can iterate across multiple queries.
-        size = self._extra.get("size", self._default_page_size)
-        from_ = self.position
-        self.position += 1
-        if from_ >= len(self._results):
-            try:
-                self._results += list(self.extra(from_=from_, size=size))
-            except IndexError:
+        if self.position >= self._page_start + len(self._page):
+            if self._pages is None:
+                size = self._extra.get("size", self._default_page_size)
+                self._pages = self._page_responses(size)
+                depth = getattr(self, "_prefetch_depth", settings.DJES_SEARCH_PREFETCH_DEPTH)
+                if depth:
+                    self._pages = read_ahead(self._pages, depth)
+
+            response = six.next(self._pages)
+            self._page_start = self.position
+            self._page = self._hydrate(response)
+            if not self._page:
                 raise StopIteration
-        try:
-            return self._results[from_]
-        except IndexError:
-            raise StopIteration
+
+        result = self._page[self.position - self._page_start]
+        self.position += 1
+        return result
+
+    def _page_responses(self, size):
+        """Returns a generator of the raw response for each page of `size` results, starting at
+        `position` (see `page_responses()`).
+
+        With `DJES_SEARCH_AFTER`, `DJES_SEARCH_AFTER_TIEBREAKER` is added to the sort, so that it's
+        stable. The generator doesn't refer back to the search, so a `prefetch()` thread running it
+        can't keep an abandoned search alive."""
+        body = self.to_dict()
+        body.pop("from", None)
+        if settings.DJES_SEARCH_AFTER:
+            body["sort"] = list(self._sort or ["_score"]) + [
+                {settings.DJES_SEARCH_AFTER_TIEBREAKER: {"order": "asc"}}
+            ]
+        es = connections.get_connection(self._using)
+        return page_responses(es, body, size, start=self.position,
+                              search_after=settings.DJES_SEARCH_AFTER, index=self._index,
+                              doc_type=self._doc_type, **self._params)
+
+    def _hydrate(self, response):
+        """Turns a raw search response into a list of results"""
+        if getattr(self, "_full", False):
+            return list(FullResponse(response).hits)
+        return list(ShallowResponse(response, callbacks=self._doc_type_map).hits)
+
+    def prefetch(self, depth=1):
+        """Returns a copy of the search whose `next()` fetches the following pages on a background
+        thread while the current page is being used, with up to `depth` of them waiting.
+
+        Only the Elasticsearch requests run on the thread; results are still hydrated (and `full()`
+        searches still query the database) on the thread that calls `next()`."""
+        s = self._clone()
+        s._prefetch_depth = depth
+        return s
+
+    def __iter__(self):
+        # Without this, a for loop would fetch results one at a time with __getitem__()
+        return iter(self.execute())
 
     def __getitem__(self, n):
-        # TODO: Investigate a better way to iterate through the entire result set.
-        if isinstance(n, int):
-            return self.execute()[n]
+        if isinstance(n, six.integer_types):
+            return self._get_result(n)
 
         if not isinstance(n, slice):
             raise TypeError("List indices must be integers")
 
         return super(LazySearch, self).__getitem__(n)
 
+    def _get_result(self, n):
+        """Returns the `n`th result of the search (or of its slice).
+
+        The result is taken from the executed response, or the current page of `next()`, if either
+        has it. Otherwise it's fetched on its own, with `from=n, size=1`."""
+        if n < 0:
+            n += len(self)
+        size = self._extra.get("size")
+        if n < 0 or (size is not None and n >= size):
+            raise IndexError("Search index out of range")
+
+        if hasattr(self, "_executed"):
+            hits = self._executed.hits
+            if n < len(hits):
+                return hits[n]
+            if size is not None or len(hits) < self._default_page_size:
+                # That's everything there is
+                raise IndexError("Search index out of range")
+
+        position = self._extra.get("from", 0) + n
+        if self._page_start <= position < self._page_start + len(self._page):
+            return self._page[position - self._page_start]
+
+        s = self.extra(from_=position, size=1)
+        es = connections.get_connection(self._using)
+        response = es.search(index=s._index, doc_type=s._doc_type, body=s.to_dict(), **s._params)
+        results = self._hydrate(response)
+        if not results:
+            raise IndexError("Search index out of range")
+        return results[0]
+
+    def stream(self, chunk_size=None, scroll=None, slice_id=None, max_slices=None):
+        """Yields every result of the search, using a scroll.
+
+        Results are fetched and hydrated `chunk_size` at a time (for `full()` searches, with one
+        `in_bulk()` per chunk and doc type), so memory use doesn't grow with the number of results.
+        On Elasticsearch 5 and up, `slice_id` and `max_slices` split the scroll into slices that can
+        be streamed in parallel. The scroll is cleared when the generator finishes, or is closed
+        early."""
+        if chunk_size is None:
+            chunk_size = settings.DJES_SCROLL_CHUNK_SIZE
+        if scroll is None:
+            scroll = settings.DJES_SCROLL_TIMEOUT
+
+        body = self.to_dict()
+        body.pop("from", None)
+        body["size"] = chunk_size
+        if max_slices is not None:
+            body["slice"] = {"id": slice_id, "max": max_slices}
+
+        es = connections.get_connection(self._using)
+        response = es.search(index=self._index, doc_type=self._doc_type, body=body, scroll=scroll,
+                             **self._params)
+        scroll_id = response.get("_scroll_id")
+        try:
+            while response["hits"]["hits"]:
+                for result in self._hydrate(response):
+                    yield result
+
+                response = es.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = response.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id:
+                es.clear_scroll(scroll_id=scroll_id, ignore=[404])
+
     def full(self):
         s = self._clone()
         s._full = True
@@ -101,6 +333,8 @@ class LazySearch(Search):
     def _clone(self):
         s = super(LazySearch, self)._clone()
         s._full = getattr(self, "_full", False)
+        if hasattr(self, "_prefetch_depth"):
+            s._prefetch_depth = self._prefetch_depth
         return s
 
     def execute(self):
@@ -0,0 +1,325 @@
+from operator import attrgetter
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import models
+from elasticsearch_dsl.field import Field
+
+
+def dynamic_accessor(key, field):
+    """Returns an accessor that works out how to serialize an attribute every time it's called.
+
+    This is used for properties, methods and anything else that we can't classify from the model's
+    fields ahead of time."""
+    from .models import Indexable
+
+    def accessor(obj):
+        attribute = getattr(obj, key)
+
+        # I believe this should take the highest priority.
+        if hasattr(field, "to_es"):
+            return field.to_es(attribute)
+
+        # First we check it this is a manager, in which case we have many related objects
+        if isinstance(attribute, models.Manager):
+            if issubclass(attribute.model, Indexable):
+                # TODO: We want this to have some awareness of the relevant field.
+                return [related.to_dict() for related in attribute.all()]
+            return list(attribute.values_list("pk", flat=True))
+
+        if callable(attribute):
+            return attribute()
+
+        if isinstance(attribute, Indexable):
+            return attribute.to_dict()
+
+        return attribute
+    return accessor
+
+
+def custom_accessor(key, field):
+    """Returns an accessor for fields that define their own `to_es()`"""
+    getter = attrgetter(key)
+    to_es = field.to_es
+
+    def accessor(obj):
+        return to_es(getter(obj))
+    return accessor
+
+
+def nested_many_accessor(key):
+    """Returns an accessor for related managers of `Indexable` models"""
+    getter = attrgetter(key)
+
+    def accessor(obj):
+        return [related.to_dict() for related in getter(obj).all()]
+    return accessor
+
+
+def pk_list_accessor(key):
+    """Returns an accessor for related managers of non-`Indexable` models"""
+    getter = attrgetter(key)
+
+    def accessor(obj):
+        queryset = getter(obj).all()
+        if queryset._result_cache is not None:
+            # The related objects were loaded by prefetch_related()
+            return [related.pk for related in queryset]
+        return list(queryset.values_list("pk", flat=True))
+    return accessor
+
+
+def nested_accessor(key):
+    """Returns an accessor for foreign keys to `Indexable` models"""
+    getter = attrgetter(key)
+
+    def accessor(obj):
+        related = getter(obj)
+        if related is None:
+            return None
+        return related.to_dict()
+    return accessor
+
+
+def get_accessor(model, key, field):
+    """Classifies a mapped property using the model's fields, and returns an accessor for it"""
+    from .models import Indexable
+
+    if hasattr(field, "to_es"):
+        return custom_accessor(key, field)
+
+    try:
+        model_field = model._meta.get_field(key)
+    except FieldDoesNotExist:
+        return dynamic_accessor(key, field)
+
+    # Generic foreign keys don't have a related model
+    related_model = model_field.related_model
+    indexable = related_model is not None and issubclass(related_model, Indexable)
+
+    if model_field.many_to_many or model_field.one_to_many:
+        if indexable:
+            return nested_many_accessor(key)
+        return pk_list_accessor(key)
+
+    if model_field.concrete and key == model_field.attname:
+        # This covers plain columns, as well as the "_id" attribute of foreign keys
+        return attrgetter(key)
+
+    if model_field.many_to_one and indexable:
+        return nested_accessor(key)
+
+    return dynamic_accessor(key, field)
+
+
+def get_related_lookups(model, prefix="", prefetching=False, seen=(), keys=None):
+    """Works out which relations serializing a model (or just the properties in `keys`) will
+    follow.
+
+    Returns a list of `select_related()` lookups for foreign keys to `Indexable` models, and a list
+    of `prefetch_related()` lookups for related managers, including those of nested objects."""
+    from .models import Indexable
+
+    select_related, prefetch_related = [], []
+    seen = set(seen) | set([model])
+
+    fields = model.search_objects.mapping.properties.properties
+    for key in fields:
+        if keys is not None and key not in keys:
+            continue
+        if hasattr(fields[key], "to_es"):
+            continue
+        try:
+            model_field = model._meta.get_field(key)
+        except FieldDoesNotExist:
+            continue
+
+        related_model = model_field.related_model
+        many = model_field.many_to_many or model_field.one_to_many
+        indexable = related_model is not None and issubclass(related_model, Indexable)
+        if not many and not (model_field.many_to_one and indexable and key != model_field.attname):
+            continue
+
+        lookup = prefix + key
+        if many or prefetching:
+            prefetch_related.append(lookup)
+        else:
+            select_related.append(lookup)
+
+        if indexable and related_model not in seen:
+            select, prefetch = get_related_lookups(
+                related_model, lookup + "__", prefetching or many, seen)
+            select_related.extend(select)
+            prefetch_related.extend(prefetch)
+
+    return select_related, prefetch_related
+
+
+class Serializer(object):
+    """A compiled plan for turning an `Indexable` object into an Elasticsearch document.
+
+    This is an ordered list of `(key, accessor)` pairs, one per mapped property, so that the
+    decision about how to serialize each property is only made once per model."""
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def __call__(self, obj):
+        out = {}
+        for key, accessor in self.steps:
+            value = accessor(obj)
+            if value is not None:
+                out[key] = value
+        return out
+
+    def only(self, keys):
+        """Returns a serializer for just the properties in `keys`"""
+        return Serializer([(key, accessor) for key, accessor in self.steps if key in keys])
+
+    @classmethod
+    def compile(cls, mapping):
+        fields = mapping.properties.properties
+        return cls([(key, get_accessor(mapping.model, key, fields[key])) for key in fields])
+
+    @classmethod
+    def compile_dynamic(cls, mapping):
+        """Returns a serializer that classifies every attribute at runtime, as `to_dict()` did"""
+        fields = mapping.properties.properties
+        return cls([(key, dynamic_accessor(key, fields[key])) for key in fields])
+
+
+def grouped_pk_list(model_field):
+    """Returns a function that loads the primary keys of a non-`Indexable` related manager for a
+    whole chunk of objects in one query, as lists keyed by the objects' primary keys"""
+    if model_field.many_to_many:
+        m2m = model_field if model_field.concrete else model_field.field
+        queryset = m2m.rel.through._default_manager.order_by("pk")
+        source, target = m2m.m2m_field_name(), m2m.m2m_reverse_field_name()
+        if not model_field.concrete:
+            source, target = target, source
+    else:
+        # A reverse foreign key
+        queryset = model_field.related_model._default_manager.order_by("pk")
+        source, target = model_field.field.name, "pk"
+
+    def load(pks):
+        grouped = dict((pk, []) for pk in pks)
+        for pk, related_pk in queryset.filter(**{source + "__in": pks}).values_list(source, target):
+            grouped[pk].append(related_pk)
+        return grouped
+    return load
+
+
+class ValuesSerializer(object):
+    """A compiled plan for building Elasticsearch documents from `values_list()` rows, without
+    creating model instances.
+
+    This only works for mappings where every property is a column, or the primary keys of a
+    non-`Indexable` related manager. Those keys are loaded with one query per chunk."""
+
+    def __init__(self, columns, pk_lists):
+        self.columns = columns
+        self.pk_lists = pk_lists
+
+    def values_list(self, queryset):
+        return queryset.values_list("pk", *[name for key, name in self.columns])
+
+    def __call__(self, rows):
+        """Returns a `(pk, document)` pair for each row in a chunk"""
+        pks = [row[0] for row in rows]
+        pk_lists = [(key, load(pks)) for key, load in self.pk_lists]
+
+        keys = [key for key, name in self.columns]
+        for row in rows:
+            out = dict((key, value) for key, value in zip(keys, row[1:]) if value is not None)
+            for key, grouped in pk_lists:
+                out[key] = grouped[row[0]]
+            yield row[0], out
+
+    def only(self, keys):
+        """Returns a serializer for just the properties in `keys`"""
+        return ValuesSerializer([(key, name) for key, name in self.columns if key in keys],
+                                [(key, load) for key, load in self.pk_lists if key in keys])
+
+    @classmethod
+    def compile(cls, mapping):
+        """Returns a `ValuesSerializer` for the mapping, or `None` if it has any properties that
+        need a model instance (custom `to_es()` fields, properties, methods or nested objects)"""
+        from .models import Indexable
+
+        columns, pk_lists = [], []
+        fields = mapping.properties.properties
+        for key in fields:
+            if hasattr(fields[key], "to_es"):
+                return None
+            try:
+                model_field = mapping.model._meta.get_field(key)
+            except FieldDoesNotExist:
+                return None
+
+            if model_field.many_to_many or model_field.one_to_many:
+                if issubclass(model_field.related_model, Indexable):
+                    return None
+                pk_lists.append((key, grouped_pk_list(model_field)))
+            elif model_field.concrete and key == model_field.attname:
+                columns.append((key, model_field.name))
+            else:
+                return None
+
+        return cls(columns, pk_lists)
+
+
+def needs_conversion(field):
+    """Returns `True` if an Elasticsearch field's `to_python()` actually changes anything"""
+    for klass in type(field).__mro__:
+        if klass is Field:
+            return False
+        if "to_python" in vars(klass) or "_to_python" in vars(klass):
+            return True
+    return False
+
+
+class Hydrator(object):
+    """A compiled plan for turning an Elasticsearch hit into a shallow model instance.
+
+    This knows ahead of time which keys in `_source` need to be dropped, and which need to be
+    converted with their field's `to_python()`. The hit itself is never modified."""
+
+    def __init__(self, klass, excludes, converters):
+        self.klass = klass
+        self.excludes = frozenset(excludes)
+        self.converters = converters
+
+    def __call__(self, hit):
+        excludes = self.excludes
+        data = dict((key, value) for key, value in hit["_source"].items() if key not in excludes)
+
+        for key, to_python in self.converters:
+            value = data.get(key)
+            if value:
+                if isinstance(value, list):
+                    # to_python() converts lists in place
+                    value = list(value)
+                data[key] = to_python(value)
+
+        return self.klass(**data)
+
+    @classmethod
+    def compile(cls, model, mapping):
+        from .factory import shallow_class_factory
+        from .models import Indexable
+
+        # We can pass in the entire source, except when we have a non-indexable many-to-many
+        excludes = [
+            field.name for field in model._meta.get_fields()
+            if not field.auto_created and field.many_to_many and
+            not issubclass(field.rel.to, Indexable)
+        ]
+
+        # TODO: What if we've mapped the property to a different name? Will we allow that?
+        fields = mapping.properties.properties
+        converters = [
+            (key, fields[key].to_python) for key in fields
+            if key not in excludes and needs_conversion(fields[key])
+        ]
+
+        return cls(shallow_class_factory(model), excludes, converters)
@@ -1,29 +1,73 @@
-import gc
+from operator import attrgetter
 
+from django.db.models import Max
 
-def batched_queryset(queryset, chunksize=1000):
-    '''''
-    Iterate over a Django Queryset ordered by the primary key
+from djes.conf import settings
 
-    This method loads a maximum of chunksize (default: 1000) rows in it's
-    memory at the same time while django normally would load all rows in it's
-    memory. Using the iterator() method only causes it to not preload all the
-    classes.
 
-    Note that the implementation of the iterator does not support ordered query sets.
+def queryset_chunks(queryset, chunksize=None, get_pk=attrgetter('pk')):
+    '''
+    Iterate over a Django Queryset in chunks (lists) of at most `chunksize` rows, ordered by the
+    primary key
+
+    This uses keyset pagination: each chunk is fetched with `pk > <last pk of the previous chunk>`,
+    so every query is cheap no matter how deep into the table we are, and rows that are deleted
+    during iteration are handled sanely. Iteration stops once it reaches the largest primary key
+    there was when it started, so rows that keep being created can't keep it going forever.
+
+    `get_pk` returns the primary key of a row, for `values()` or `values_list()` query sets.
 
-    Source: https://djangosnippets.org/snippets/1949/
+    Note that this does not support ordered query sets.
     '''
-    try:
-        last_pk = queryset.order_by('-pk')[0].pk
-    except IndexError:
+    if chunksize is None:
+        chunksize = settings.DJES_QUERY_CHUNK_SIZE
+
+    max_pk = queryset.aggregate(max_pk=Max('pk'))['max_pk']
+    if max_pk is None:
         # Support empty querysets
         return
 
     queryset = queryset.order_by('pk')
-    pk = 0
-    while pk < last_pk:
-        for row in queryset.filter(pk__gt=pk)[:chunksize]:
-            pk = row.pk
+    last_pk = None
+    while last_pk is None or last_pk < max_pk:
+        if last_pk is None:
+            chunk = list(queryset[:chunksize])
+        else:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:chunksize])
+
+        if not chunk:
+            return
+        yield chunk
+        last_pk = get_pk(chunk[-1])
+
+
+def batched_queryset(queryset, chunksize=None):
+    '''
+    Iterate over a Django Queryset ordered by the primary key
+
+    This method loads a maximum of chunksize (default: `DJES_QUERY_CHUNK_SIZE`) rows in its memory
+    at the same time while django normally would load all rows in its memory. Using the
+    iterator() method only causes it to not preload all the classes.
+
+    Note that the implementation of the iterator does not support ordered query sets.
+    '''
+    for chunk in queryset_chunks(queryset, chunksize=chunksize):
+        for row in chunk:
             yield row
-        gc.collect()
+
+
+def exact_model_filter(model):
+    '''
+    Returns filter lookups that exclude rows belonging to multi-table inheritance children
+
+    A query against a parent model returns every row in the parent's table, including the rows
+    that belong to subclasses, which are indexed with their own mappings.
+    '''
+    lookups = {}
+    for related in model._meta.related_objects:
+        field = related.field
+        if not related.one_to_one or not field.rel.parent_link:
+            continue
+        if issubclass(related.related_model, model):
+            lookups["{}__isnull".format(field.related_query_name())] = True
+    return lookups
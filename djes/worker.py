@@ -0,0 +1,269 @@
+import atexit
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from six.moves import queue
+
+from elasticsearch.helpers import BulkIndexError
+
+from .buffer import IndexingBuffer
+from .conf import settings
+
+
+logger = logging.getLogger("djes.worker")
+
+INTERACTIVE = 0
+BACKGROUND = 1
+_STOP_PRIORITY = 2
+
+_STOP = object()
+
+_local = threading.local()
+
+
+def get_current_priority():
+    """Returns the priority that operations queued from this thread get"""
+    return getattr(_local, "priority", INTERACTIVE)
+
+
+@contextmanager
+def background_indexing():
+    """Marks the index and delete operations queued inside the block as background work.
+
+    The worker always sends interactive operations (the default) before background ones, so a
+    backfill running in the same process can't hold up live writes."""
+    previous = get_current_priority()
+    _local.priority = BACKGROUND
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class IndexingWorker(object):
+    """Sends index and delete operations to Elasticsearch from background threads.
+
+    Operations are put on a bounded priority queue, and the worker threads drain it in bulk
+    batches, interactive operations first. When the queue is full, `full_policy` decides what
+    happens: "block" waits for room, "drop" throws the operation away, and "sync" sends it from
+    the calling thread instead."""
+
+    FULL_POLICIES = ("block", "drop", "sync")
+
+    def __init__(self, queue_size=10000, threads=1, batch_size=500, full_policy="block"):
+        if full_policy not in self.FULL_POLICIES:
+            raise ValueError("Unknown full_policy \"{}\"".format(full_policy))
+
+        self.queue = queue.PriorityQueue(maxsize=queue_size)
+        # Keeps operations with the same priority in the order they were queued
+        self._sequence = itertools.count()
+        self.thread_count = threads
+        self.batch_size = batch_size
+        self.full_policy = full_policy
+
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.synchronous = 0
+        self.superseded = 0
+        self.last_batch_lag = 0.0
+
+        self._lock = threading.Lock()
+        # The sequence number of the latest queued operation for each document, so that an older
+        # operation that's sent later (because it has a lower priority) can be skipped
+        self._latest = {}
+        self._threads = []
+
+    @property
+    def running(self):
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self):
+        if self.running:
+            return
+        self._threads = []
+        for i in range(self.thread_count):
+            thread = threading.Thread(target=self._run, name="djes-worker-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, action, priority=None):
+        """Queues a bulk action, applying the `full_policy` if the queue is full.
+
+        `priority` is `INTERACTIVE` or `BACKGROUND`, and defaults to `get_current_priority()`."""
+        if priority is None:
+            priority = get_current_priority()
+        item = (priority, next(self._sequence), time.time(), action)
+        key = (action["_index"], action["_type"], action["_id"])
+        with self._lock:
+            previous = self._latest.get(key)
+            self._latest[key] = item[1]
+
+        if self.full_policy == "block":
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                if self.full_policy == "drop":
+                    with self._lock:
+                        if self._latest.get(key) == item[1]:
+                            if previous is None:
+                                del self._latest[key]
+                            else:
+                                self._latest[key] = previous
+                    self._count("dropped")
+                    logger.warning("Indexing queue is full, dropping %s for %s/%s",
+                                   action["_op_type"], action["_type"], action["_id"])
+                    return
+                self._count("synchronous")
+                self._send([item])
+                return
+        self._count("enqueued")
+
+    def flush(self):
+        """Blocks until everything that has been queued so far has been sent"""
+        if self.running:
+            self.queue.join()
+
+    def shutdown(self):
+        """Sends everything left on the queue, and stops the worker threads"""
+        if not self.running:
+            return
+        for thread in self._threads:
+            # These sort after everything else, so whatever is queued is sent first
+            self.queue.put((_STOP_PRIORITY, next(self._sequence), None, _STOP))
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    @property
+    def lag(self):
+        """The number of seconds the oldest queued operation has been waiting"""
+        with self.queue.mutex:
+            queued = [item[2] for item in self.queue.queue if item[3] is not _STOP]
+        if not queued:
+            return 0.0
+        return time.time() - min(queued)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "lag": self.lag,
+            "last_batch_lag": self.last_batch_lag,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "synchronous": self.synchronous,
+            "superseded": self.superseded,
+        }
+
+    def _count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item[3] is _STOP:
+                self.queue.task_done()
+                return
+
+            batch = [item]
+            stopping = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item[3] is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                self._send(batch)
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+            if stopping:
+                self.queue.task_done()
+                return
+
+    def _claim(self, batch):
+        """Returns the operations in a batch that haven't been superseded by a later operation on
+        the same document"""
+        claimed = []
+        with self._lock:
+            for item in batch:
+                action = item[3]
+                key = (action["_index"], action["_type"], action["_id"])
+                if self._latest.get(key) == item[1]:
+                    del self._latest[key]
+                    claimed.append(item)
+        return claimed
+
+    def _send(self, batch):
+        self.last_batch_lag = time.time() - min(item[2] for item in batch)
+
+        claimed = self._claim(batch)
+        self._count("superseded", len(batch) - len(claimed))
+        batch = claimed
+        if not batch:
+            return
+
+        buffer = IndexingBuffer()
+        for priority, sequence, queued_at, action in batch:
+            buffer.add(action)
+
+        try:
+            buffer.flush()
+        except BulkIndexError as e:
+            # Errors name the concrete index, which can be an index being rebuilt rather than the
+            # alias that the operation was for, so they're matched up by document
+            errors = set()
+            for error in e.errors:
+                info = list(error.values())[0]
+                errors.add((info.get("_type"), str(info.get("_id"))))
+            failed = len([
+                item for item in batch if (item[3]["_type"], str(item[3]["_id"])) in errors
+            ])
+            self._count("failed", failed)
+            self._count("sent", len(batch) - failed)
+            logger.error("%s", e.args[0], extra={"errors": e.errors})
+        except Exception:
+            self._count("failed", len(batch))
+            logger.exception("Failed to send %s queued operation(s)", len(batch))
+        else:
+            self._count("sent", len(batch))
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker():
+    """Returns the process-wide `IndexingWorker`, starting it if necessary"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = IndexingWorker(
+                queue_size=settings.DJES_ASYNC_QUEUE_SIZE,
+                threads=settings.DJES_ASYNC_THREADS,
+                batch_size=settings.DJES_ASYNC_BATCH_SIZE,
+                full_policy=settings.DJES_ASYNC_FULL_POLICY
+            )
+            atexit.register(_worker.shutdown)
+        _worker.start()
+        return _worker
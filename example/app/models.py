@@ -173,6 +173,20 @@ class DumbTag(models.Model):
     name = models.CharField(max_length=255)
 
 
+class ValuesObject(Indexable):
+    name = models.CharField(max_length=255)
+    count = models.IntegerField()
+    published = models.DateTimeField(null=True, blank=True)
+    simple = models.ForeignKey(RelatedSimpleObject, null=True)
+    dumb_tags = models.ManyToManyField(DumbTag, related_name="values_objects")
+    updated = models.DateTimeField(auto_now=True)
+
+    class Mapping:
+        class Meta:
+            from_values = True
+            modified_field = "updated"
+
+
 class RelationsTestObject(Indexable):
     data = models.CharField(max_length=255)
     tags = models.ManyToManyField(Tag, related_name="tag")
@@ -0,0 +1,56 @@
+"""Measures how quickly documents can be built for the example models.
+
+Compares the compiled `Serializer` that `to_dict()` uses against one that classifies every
+attribute at runtime (the way `to_dict()` used to work). Nothing is sent to Elasticsearch:
+
+    $ DJANGO_SETTINGS_MODULE=example.settings python -m example.benchmark
+"""
+import time
+
+import django
+
+
+def documents_per_second(serializer, objects, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        for obj in objects:
+            serializer(obj)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(objects) / best
+
+
+def main(count=5000):
+    django.setup()
+
+    from model_mommy import mommy
+
+    from djes.serializers import Serializer
+    from example.app.models import (
+        SimpleObject, ManualMappingObject, CustomFieldObject, RelatableObject,
+        RelatedSimpleObject, RelatedNestedObject
+    )
+
+    print("{:<24}{:>16}{:>16}{:>10}".format(
+        "Model", "dynamic docs/s", "compiled docs/s", "speedup"))
+    for model in (SimpleObject, ManualMappingObject, CustomFieldObject, RelatableObject):
+        # Nothing is saved, so this doesn't need a database or Elasticsearch
+        if model is RelatableObject:
+            simple = RelatedSimpleObject(id=1, datums="datums")
+            nested = RelatedNestedObject(id=1, denormalized_datums="datums")
+            objects = [model(name="name", simple=simple, nested=nested) for _ in range(count)]
+        else:
+            objects = mommy.prepare(model, _quantity=count)
+        for pk, obj in enumerate(objects, start=1):
+            obj.pk = pk
+
+        mapping = model.search_objects.mapping
+        dynamic = documents_per_second(Serializer.compile_dynamic(mapping), objects)
+        compiled = documents_per_second(mapping.serializer, objects)
+        print("{:<24}{:>16.0f}{:>16.0f}{:>9.2f}x".format(
+            model.__name__, dynamic, compiled, compiled / dynamic))
+
+
+if __name__ == "__main__":
+    main()
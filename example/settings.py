@@ -27,6 +27,8 @@ ES_CONNECTIONS = {
 }
 
 ES_INDEX = "djes-example"
+# Send writes to new indexes while they're built, looking for builds on every write
+DJES_BUILD_ALIAS_TTL = 0
 ES_INDEX_SETTINGS = {
     "djes-example": {
         "index": {
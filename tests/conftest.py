@@ -24,3 +24,63 @@ def es_client(request):
 
     request.addfinalizer(fin)
     return es  # provide the fixture value
+
+
+class FakeElasticsearch(object):
+    """Answers searches from `hits`, without a cluster, and records the body and parameters of each
+    one in `requests`"""
+
+    def __init__(self):
+        self.hits = []
+        self.requests = []
+        self.cleared = []
+        # Searches starting at or past this raise an error
+        self.fail_from = None
+
+    def simple_hits(self, ids):
+        """Returns a hit for the `SimpleObject` with each of `ids`"""
+        return [
+            {
+                "_index": "djes-example_0001",
+                "_type": "app_simpleobject",
+                "_id": str(i),
+                "_source": {"id": i, "foo": i, "bar": "bar", "baz": "baz"},
+            }
+            for i in ids
+        ]
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        self.requests.append((body, params))
+        if "search_after" in body:
+            start = [hit["sort"] for hit in self.hits].index(body["search_after"]) + 1
+        else:
+            start = body.get("from", 0)
+        if self.fail_from is not None and start >= self.fail_from:
+            raise ValueError("Something went wrong")
+
+        total = len(self.hits)
+        if "terminate_after" in params:
+            # Each of the two shards stops after `terminate_after` matches
+            total = min(total, 2 * params["terminate_after"])
+        size = body.get("size", 10)
+        response = {"hits": {"total": total, "hits": self.hits[start:start + size]}}
+        if "scroll" in params:
+            self.scroll_size = size
+            response["_scroll_id"] = "0"
+        return response
+
+    def scroll(self, scroll_id=None, scroll=None):
+        start = (int(scroll_id) + 1) * self.scroll_size
+        return {"_scroll_id": str(int(scroll_id) + 1),
+                "hits": {"total": len(self.hits),
+                         "hits": self.hits[start:start + self.scroll_size]}}
+
+    def clear_scroll(self, scroll_id=None, ignore=None):
+        self.cleared.append(scroll_id)
+
+
+@pytest.fixture
+def fake_es(monkeypatch):
+    es = FakeElasticsearch()
+    monkeypatch.setattr(connections, "get_connection", lambda using: es)
+    return es
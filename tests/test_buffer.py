@@ -0,0 +1,70 @@
+import pytest
+from model_mommy import mommy
+
+import djes
+from djes.buffer import get_current_buffer
+
+from example.app.models import SimpleObject
+
+
+@pytest.mark.django_db
+def test_batch_indexing(es_client):
+    with djes.batch_indexing() as buffer:
+        objects = mommy.make(SimpleObject, _quantity=10)
+        assert len(buffer) == 10
+
+        # Nothing is sent until the block exits
+        SimpleObject.search_objects.refresh()
+        assert SimpleObject.search_objects.search().count() == 0
+
+    assert get_current_buffer() is None
+
+    SimpleObject.search_objects.refresh()
+    assert SimpleObject.search_objects.search().count() == 10
+
+    with djes.batch_indexing():
+        objects[0].save(index=False)
+        objects[1].delete()
+
+    SimpleObject.search_objects.refresh()
+    assert SimpleObject.search_objects.search().count() == 8
+
+
+@pytest.mark.django_db
+def test_batch_indexing_deduplicates():
+    with djes.batch_indexing() as buffer:
+        obj = mommy.make(SimpleObject, foo=1)
+        obj.foo = 2
+        obj.save()
+        obj.save(index=False)
+        obj.save()
+
+        assert len(buffer) == 1
+        action = list(buffer.actions.values())[0]
+        assert action["_op_type"] == "index"
+        assert action["_source"]["foo"] == 2
+
+        # Clear the buffer so that the test doesn't need elasticsearch
+        buffer.clear()
+
+
+@pytest.mark.django_db
+def test_batch_indexing_rollback():
+    with pytest.raises(ValueError):
+        with djes.batch_indexing() as buffer:
+            mommy.make(SimpleObject, _quantity=3)
+            raise ValueError()
+
+    assert len(buffer) == 0
+    assert SimpleObject.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_nested_batch_indexing():
+    with djes.batch_indexing() as outer:
+        mommy.make(SimpleObject)
+        with djes.batch_indexing() as inner:
+            mommy.make(SimpleObject, _quantity=2)
+            assert len(inner) == 2
+        assert len(outer) == 3
+        outer.clear()
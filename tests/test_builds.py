@@ -0,0 +1,94 @@
+import pytest
+from elasticsearch_dsl.connections import connections
+from model_mommy import mommy
+
+import djes
+from djes import builds, bulk
+from djes.builds import clear_build_targets, get_build_alias, get_build_targets, with_build_targets
+from djes.bulk import index_model
+from djes.management.commands.sync_es import get_indexes
+
+from example.app.models import SimpleObject
+
+
+def test_with_build_targets(monkeypatch):
+    monkeypatch.setattr(builds, "get_build_targets",
+                        lambda index: ["djes-example_0002"] if index == "djes-example" else [])
+    monkeypatch.setattr(builds, "get_live_version", lambda: 1234)
+
+    actions = [
+        {"_op_type": "index", "_index": "djes-example", "_type": "app_simpleobject", "_id": 1},
+        {"_op_type": "delete", "_index": "djes-other", "_type": "app_simpleobject", "_id": 2},
+        {"_op_type": "update", "_index": "djes-example", "_type": "app_simpleobject", "_id": 3},
+    ]
+    assert list(with_build_targets(actions)) == [
+        actions[0],
+        dict(actions[0], _index="djes-example_0002", _version=1234, _version_type="external_gte"),
+        actions[1],
+        actions[2],
+        dict(actions[2], _index="djes-example_0002"),
+    ]
+
+
+@pytest.mark.django_db
+def test_index_model_build_targets(monkeypatch):
+    monkeypatch.setattr(builds, "get_build_targets",
+                        lambda index: ["djes-example_0002"] if index == "djes-example" else [])
+    sent = []
+
+    def send_chunk(es, chunk, **kwargs):
+        sent.extend(action for action, lines in chunk)
+        return [
+            (action["_index"] == "djes-example", {"update": {"_id": action["_id"], "status": 404}})
+            for action, lines in chunk
+        ]
+    monkeypatch.setattr(bulk, "send_chunk", send_chunk)
+
+    objects = mommy.make(SimpleObject, _quantity=3)
+    progress = []
+    success, errors = index_model(SimpleObject, es=connections.get_connection("default"),
+                                  fields=["foo"], progress=progress.append)
+    # Each action is copied once, straight after it, and keeps its partial update
+    assert [(action["_index"], action["_op_type"], action["doc"]) for action in sent] == [
+        (index, "update", {"foo": obj.foo})
+        for obj in objects for index in ("djes-example", "djes-example_0002")
+    ]
+    assert (success, errors) == (3, [])
+    assert progress == [obj.pk for obj in objects]
+
+
+@pytest.mark.django_db
+def test_dual_writes(es_client):
+    build = "djes-example_0099"
+    doc_type = SimpleObject.search_objects.mapping.doc_type
+    es_client.indices.delete(build, ignore=[404])
+    es_client.indices.create(index=build, body=get_indexes()["djes-example"])
+    es_client.indices.put_alias(index=build, name=get_build_alias("djes-example"))
+    clear_build_targets()
+
+    try:
+        assert get_build_targets("djes-example") == [build]
+        assert get_build_targets(build) == []
+
+        obj = mommy.make(SimpleObject)
+        with djes.batch_indexing():
+            other = mommy.make(SimpleObject)
+        assert es_client.exists(build, doc_type, obj.pk)
+        assert es_client.exists(build, doc_type, other.pk)
+
+        obj.delete()
+        assert not es_client.exists(build, doc_type, obj.pk)
+
+        # Loading the new index leaves documents that live writes put there alone, and doesn't
+        # bring back documents that were deleted after it read them
+        other.foo += 1
+        other.save()
+        stale = mommy.make(SimpleObject)
+        stale.delete_index()
+        success, errors = index_model(SimpleObject, es=es_client, index=build, op_type="create")
+        assert (success, errors) == (2, [])
+        assert es_client.get(build, doc_type, other.pk)["_source"]["foo"] == other.foo
+        assert not es_client.exists(build, doc_type, stale.pk)
+    finally:
+        es_client.indices.delete(build)
+        clear_build_targets()
@@ -1,12 +1,26 @@
+from django.conf import settings
 from django.core import management
+from django.core.management.base import CommandError
+from django.db import connection, reset_queries
 
 import pytest
 import time
+from datetime import datetime, timedelta
 from model_mommy import mommy
 
-from djes.management.commands.bulk_index import model_iterator
+from djes import bulk
+from djes.bulk import (
+    ChunkSizer, TokenBucket, chunk_actions, index_model, send_chunk_with_retries, summarize_errors
+)
+from djes.serializers import ValuesSerializer
+from djes.management.commands.bulk_index import (
+    Checkpoint, changed_queryset, get_pk_ranges, model_index, model_iterator, parse_since
+)
 
-from example.app.models import SimpleObject
+from example.app.models import (
+    SimpleObject, RelatableObject, RelationsTestObject, Tag, DumbTag, RelatedSimpleObject,
+    ValuesObject
+)
 
 
 @pytest.mark.django_db
@@ -44,3 +58,348 @@ def test_bulk_index_called_in_sync_es(es_client):
     management.call_command("sync_es")
     assert es_client.indices.exists_alias(name='djes-example') is True
     assert es_client.indices.exists('djes-example_0001') is True
+
+
+@pytest.mark.django_db
+def test_get_pk_ranges(es_client):
+    assert get_pk_ranges(SimpleObject, 4) == []
+
+    objects = mommy.make(SimpleObject, _quantity=10)
+    first, last = objects[0].pk, objects[-1].pk
+
+    ranges = get_pk_ranges(SimpleObject, 4)
+    assert ranges == [(first, first + 2), (first + 3, first + 5), (first + 6, first + 8),
+                      (first + 9, last)]
+
+    assert get_pk_ranges(SimpleObject, 20) == [(pk, pk) for pk in range(first, last + 1)]
+
+
+# The worker processes use their own connections, so the rows have to be committed
+@pytest.mark.django_db(transaction=True)
+def test_bulk_index_workers(es_client):
+    mommy.make(SimpleObject, _quantity=120)
+    management.call_command("bulk_index", workers=2)
+    SimpleObject.search_objects.refresh()
+
+    response = es_client.search(
+        index=SimpleObject.search_objects.mapping.index,
+        doc_type=SimpleObject.search_objects.mapping.doc_type
+    )
+    assert response["hits"]["total"] == 120
+
+
+@pytest.mark.django_db
+def test_chunk_actions(es_client):
+    mommy.make(SimpleObject, _quantity=10)
+
+    chunks = list(chunk_actions(es_client, model_iterator(SimpleObject), chunk_size=3))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+
+    # A single document bigger than the limit still gets a chunk of its own
+    chunks = list(chunk_actions(es_client, model_iterator(SimpleObject), max_chunk_bytes=1))
+    assert [len(chunk) for chunk in chunks] == [1] * 10
+
+
+@pytest.mark.django_db
+def test_index_model_concurrency(es_client):
+    mommy.make(SimpleObject, _quantity=120)
+
+    success, errors = index_model(SimpleObject, thread_count=4, chunk_size=7)
+    assert success == 120
+    assert errors == []
+
+    management.call_command("bulk_index", concurrency=3, chunk_size=10, max_chunk_bytes=4096)
+    SimpleObject.search_objects.refresh()
+    assert SimpleObject.search_objects.search().count() == 120
+
+
+@pytest.mark.django_db
+def test_related_lookups(es_client):
+    assert RelatableObject.search_objects.related_lookups == (["nested"], [])
+    select_related, prefetch_related = RelationsTestObject.search_objects.related_lookups
+    assert select_related == []
+    assert sorted(prefetch_related) == ["dumb_tags", "tags"]
+
+
+@pytest.mark.django_db
+def test_model_iterator_queries(es_client):
+    tags = mommy.make(Tag, _quantity=2)
+    dumb_tags = mommy.make(DumbTag, _quantity=2)
+
+    def count_queries():
+        try:
+            settings.DEBUG = True  # Must be TRUE to track connection queries
+            reset_queries()
+            actions = list(model_iterator(RelationsTestObject, chunksize=100))
+            return len(actions), len(connection.queries)
+        finally:
+            settings.DEBUG = False
+
+    mommy.make(RelationsTestObject, tags=tags, dumb_tags=dumb_tags, _quantity=5)
+    assert count_queries() == (5, 5)  # count, max pk, the chunk, and one per related manager
+
+    obj = mommy.make(RelationsTestObject, tags=tags, dumb_tags=dumb_tags, _quantity=20)[-1]
+    assert count_queries() == (25, 5)
+
+    actions = model_iterator(RelationsTestObject)
+    actions = dict((action["_id"], action["_source"]) for action in actions)
+    assert actions[obj.pk] == RelationsTestObject.objects.get(pk=obj.pk).to_dict()
+    assert sorted(actions[obj.pk]["dumb_tags"]) == sorted(tag.pk for tag in dumb_tags)
+
+
+@pytest.mark.django_db
+def test_manager_bulk_index(es_client):
+    objects = mommy.make(SimpleObject, _quantity=10)
+
+    queryset = SimpleObject.objects.filter(pk__lte=objects[4].pk)
+    success, errors = SimpleObject.search_objects.bulk_index(queryset=queryset)
+    assert success == 5
+    assert errors == []
+
+
+@pytest.mark.django_db
+def test_values_serializer(es_client):
+    assert ValuesObject.search_objects.mapping.values_serializer is not None
+    assert SimpleObject.search_objects.mapping.values_serializer is None  # Not enabled
+    # Nested objects and custom fields need model instances
+    assert ValuesSerializer.compile(RelatableObject.search_objects.mapping) is None
+    assert ValuesSerializer.compile(RelationsTestObject.search_objects.mapping) is None
+
+    simple = mommy.make(RelatedSimpleObject)
+    dumb_tags = mommy.make(DumbTag, _quantity=3)
+    objects = mommy.make(ValuesObject, simple=simple, dumb_tags=dumb_tags, _quantity=10)
+    objects.append(mommy.make(ValuesObject))
+
+    try:
+        settings.DEBUG = True  # Must be TRUE to track connection queries
+        reset_queries()
+        actions = list(model_iterator(ValuesObject, chunksize=100))
+        assert len(connection.queries) == 4  # count, max pk, the chunk, and the grouped m2m
+    finally:
+        settings.DEBUG = False
+
+    documents = dict((action["_id"], action["_source"]) for action in actions)
+    for obj in objects:
+        expected = ValuesObject.objects.get(pk=obj.pk).to_dict()
+        assert sorted(documents[obj.pk].pop("dumb_tags")) == sorted(expected.pop("dumb_tags"))
+        assert documents[obj.pk] == expected
+
+
+@pytest.mark.django_db
+def test_model_iterator_fields(es_client):
+    dumb_tags = mommy.make(DumbTag, _quantity=2)
+    objects = mommy.make(RelationsTestObject, tags=mommy.make(Tag, _quantity=2),
+                         dumb_tags=dumb_tags, _quantity=5)
+    values_objects = mommy.make(ValuesObject, dumb_tags=dumb_tags, _quantity=5)
+
+    try:
+        settings.DEBUG = True  # Must be TRUE to track connection queries
+        reset_queries()
+        actions = list(model_iterator(RelationsTestObject, fields=["data", "dumb_tags"]))
+        assert len(connection.queries) == 4  # count, max pk, the chunk, and only the dumb tags
+        reset_queries()
+        values_actions = list(model_iterator(ValuesObject, fields=["name"]))
+        assert len(connection.queries) == 3  # count, max pk and the chunk
+    finally:
+        settings.DEBUG = False
+
+    for obj, action in zip(objects, actions):
+        assert action["_op_type"] == "update"
+        assert sorted(action["doc"].pop("dumb_tags")) == sorted(tag.pk for tag in dumb_tags)
+        assert action["doc"] == {"data": obj.data}
+    for obj, action in zip(values_objects, values_actions):
+        assert action["doc"] == {"name": obj.name}
+
+
+def test_parse_since():
+    now = datetime(2016, 5, 4, 12, 0, 0)
+    assert parse_since("30m", now=now) == datetime(2016, 5, 4, 11, 30, 0)
+    assert parse_since("1h", now=now) == datetime(2016, 5, 4, 11, 0, 0)
+    assert parse_since("2d", now=now) == datetime(2016, 5, 2, 12, 0, 0)
+    assert parse_since("2016-05-01T08:15:00") == datetime(2016, 5, 1, 8, 15, 0)
+    assert parse_since("2016-05-01") == datetime(2016, 5, 1, 0, 0, 0)
+    with pytest.raises(CommandError):
+        parse_since("yesterday")
+
+
+@pytest.mark.django_db
+def test_changed_queryset(es_client):
+    old = mommy.make(ValuesObject, _quantity=3)
+    ValuesObject.objects.update(updated=datetime.now() - timedelta(days=1))
+    new = mommy.make(ValuesObject, _quantity=2)
+
+    since = datetime.now() - timedelta(hours=1)
+    assert list(changed_queryset(ValuesObject, since=since).order_by("pk")) == new
+    assert list(changed_queryset(ValuesObject, ids=[old[0].pk, new[0].pk]).order_by("pk")) == [
+        old[0], new[0]]
+    assert list(changed_queryset(ValuesObject, since=since, ids=[old[0].pk])) == []
+    # No modified_field
+    assert changed_queryset(SimpleObject, since=since) is None
+
+
+@pytest.mark.django_db
+def test_bulk_index_since(es_client):
+    objects = mommy.make(ValuesObject, _quantity=5)
+    for obj in objects:
+        obj.delete_index()
+    ValuesObject.search_objects.refresh()
+    assert ValuesObject.search_objects.search().count() == 0
+
+    management.call_command("bulk_index", since="1h")
+    ValuesObject.search_objects.refresh()
+    assert ValuesObject.search_objects.search().count() == 5
+
+    objects[0].delete_index()
+    ValuesObject.search_objects.refresh()
+    management.call_command("bulk_index", model=["app.ValuesObject"], ids=str(objects[0].pk))
+    ValuesObject.search_objects.refresh()
+    assert ValuesObject.search_objects.search().count() == 5
+
+    with pytest.raises(CommandError):
+        management.call_command("bulk_index", ids="1,2")
+    with pytest.raises(CommandError):
+        management.call_command("bulk_index", model=["app.DumbTag"])
+
+
+@pytest.mark.django_db
+def test_bulk_index_fields(es_client):
+    objects = mommy.make(ValuesObject, count=1, _quantity=5)
+    # Changes that haven't been indexed
+    ValuesObject.objects.update(name="backfilled", count=2)
+
+    management.call_command("bulk_index", model=["app.ValuesObject"], fields="name")
+    doc_type = ValuesObject.search_objects.mapping.doc_type
+    for obj in objects:
+        document = es_client.get("djes-example", doc_type, obj.pk)["_source"]
+        assert document["name"] == "backfilled"
+        assert document["count"] == 1
+
+    with pytest.raises(CommandError):
+        management.call_command("bulk_index", fields="name")
+    with pytest.raises(CommandError):
+        management.call_command("bulk_index", model=["app.ValuesObject"], fields="nope")
+
+
+@pytest.mark.django_db
+def test_model_index_checkpoint(es_client, tmpdir, monkeypatch):
+    sent = []
+
+    def send_chunk(es, chunk, **kwargs):
+        sent.extend(action["_id"] for action, lines in chunk)
+        return [(True, {"index": {"_id": str(action["_id"])}}) for action, lines in chunk]
+    monkeypatch.setattr(bulk, "send_chunk", send_chunk)
+
+    objects = mommy.make(SimpleObject, _quantity=10)
+    pks = [obj.pk for obj in objects]
+
+    path = str(tmpdir.join("checkpoint.json"))
+    checkpoint = Checkpoint(path)
+    checkpoint.start("djes-example_0002")
+    model_index(es_client, SimpleObject, "djes-example_0002", checkpoint=checkpoint)
+    assert sent == pks
+    assert Checkpoint.load(path).get_ranges("djes-example_0002", "app.SimpleObject") == [
+        [None, None, str(pks[-1]), True]]
+
+    # Pretend that indexing stopped halfway through
+    checkpoint.set_ranges("djes-example_0002", "app.SimpleObject", [[None, None, pks[4], False]])
+    del sent[:]
+    model_index(es_client, SimpleObject, "djes-example_0002", checkpoint=Checkpoint.load(path))
+    assert sent == pks[5:]
+
+    checkpoint.finish("djes-example_0002")
+    assert not tmpdir.join("checkpoint.json").exists()
+
+
+@pytest.mark.django_db
+def test_model_index_checkpoint_failures(es_client, tmpdir, monkeypatch):
+    objects = mommy.make(SimpleObject, _quantity=10)
+    pks = [obj.pk for obj in objects]
+
+    def send_chunk(es, chunk, **kwargs):
+        return [
+            (action["_id"] != pks[3], {"index": {"_id": str(action["_id"]), "status": 400}})
+            for action, lines in chunk
+        ]
+    monkeypatch.setattr(bulk, "send_chunk", send_chunk)
+
+    checkpoint = Checkpoint(str(tmpdir.join("checkpoint.json")))
+    checkpoint.start("djes-example_0002")
+    errors = model_index(es_client, SimpleObject, "djes-example_0002", checkpoint=checkpoint)
+    assert len(errors) == 1
+    # Resuming starts again from the failure
+    assert checkpoint.get_ranges("djes-example_0002", "app.SimpleObject") == [
+        [None, None, str(pks[2]), False]]
+
+
+def test_chunk_sizer():
+    sizer = ChunkSizer(100)
+    sizer.record(0.5, rejected=3)
+    assert sizer.size == 50
+    sizer.record(0.5)
+    assert sizer.size == 63
+    for _ in range(10):
+        sizer.record(0.5)
+    assert sizer.size == 100  # Never grows past where it started
+    for _ in range(10):
+        sizer.record(0.5, rejected=1)
+    assert sizer.size == 10
+
+    sizer = ChunkSizer(100, maximum=1000, target_latency=1.0)
+    sizer.record(2.0)
+    assert sizer.size == 75
+    sizer.record(0.75)
+    assert sizer.size == 75
+    sizer.record(0.1)
+    assert sizer.size == 94
+
+
+def test_send_chunk_with_retries(monkeypatch):
+    attempts = []
+
+    def send_chunk(es, chunk, **kwargs):
+        attempts.append([action["_id"] for action, lines in chunk])
+        results = []
+        for action, lines in chunk:
+            if action["_id"] % 2 and len(attempts) < 3:
+                results.append((False, {"index": {"_id": action["_id"], "status": 429}}))
+            elif action["_id"] == 4:
+                results.append((False, {"index": {"_id": action["_id"], "status": 400}}))
+            else:
+                results.append((True, {"index": {"_id": action["_id"], "status": 201}}))
+        return results
+    monkeypatch.setattr(bulk, "send_chunk", send_chunk)
+
+    chunk = [({"_id": i}, []) for i in range(6)]
+    sizer = ChunkSizer(6, minimum=1)
+    results = send_chunk_with_retries(None, chunk, sizer=sizer, initial_backoff=0)
+    # Only rejected actions are sent again
+    assert attempts == [[0, 1, 2, 3, 4, 5], [1, 3, 5], [1, 3, 5]]
+    assert [ok for ok, item in results] == [True, True, True, True, False, True]
+    assert sizer.size < 6
+
+    del attempts[:]
+    results = send_chunk_with_retries(None, chunk, max_retries=1, initial_backoff=0)
+    assert [ok for ok, item in results] == [True, False, True, False, False, False]
+
+
+def test_summarize_errors():
+    errors = [
+        {"index": {"status": 400, "error": "MapperParsingException[failed to parse [foo]]"}},
+        {"index": {"status": 400, "error": "MapperParsingException[failed to parse [bar]]"}},
+        {"index": {"status": 400, "error": {"type": "mapper_parsing_exception"}}},
+        {"index": {"status": 429, "error": "EsRejectedExecutionException[rejected execution]"}},
+        {"delete": {"status": 500}},
+    ]
+    assert summarize_errors(errors) == {
+        "MapperParsingException": 2,
+        "mapper_parsing_exception": 1,
+        "EsRejectedExecutionException": 1,
+        "status 500": 1,
+    }
+
+
+def test_token_bucket():
+    bucket = TokenBucket(1000)
+    assert bucket.consume(600) == 0
+    # Only about 400 left, so this has to wait for about another 200
+    assert 0.1 < bucket.consume(600) < 0.3
@@ -1,4 +1,5 @@
 import pytest
+from djes.serializers import Serializer, get_accessor
 from example.app.models import *  # noqa
 from model_mommy import mommy
 from django.utils import timezone
@@ -137,3 +138,47 @@ def test_save_index():
     content.save(index=True)
     SimpleObject.search_objects.refresh()
     assert 1 == SimpleObject.search_objects.search().count()
+
+
+@pytest.mark.django_db
+def test_compiled_serializer(es_client):
+    tags = mommy.make(Tag, _quantity=2)
+    dumb_tags = mommy.make(DumbTag, _quantity=2)
+    relations = mommy.make(RelationsTestObject, make_m2m=False)
+    relations.tags.add(*tags)
+    relations.dumb_tags.add(*dumb_tags)
+
+    parent = ReverseRelationsParentObject.objects.create(name="parent")
+    ReverseRelationsChildObject.objects.create(name="child", parent=parent)
+
+    objects = [
+        relations,
+        parent,
+        mommy.make(ManualMappingObject),
+        mommy.make(RelatableObject),
+        CustomFieldObject.objects.create(color="#008E50"),
+    ]
+    for obj in objects:
+        mapping = obj.mapping
+        assert mapping.serializer(obj) == Serializer.compile_dynamic(mapping)(obj)
+
+
+def test_generic_foreign_key_accessor():
+    class GenericForeignKey(object):
+        # Like Django's, it's many-to-one but has no related model
+        many_to_many = one_to_many = concrete = False
+        many_to_one = True
+        related_model = None
+
+    class Meta(object):
+        def get_field(self, key):
+            return GenericForeignKey()
+
+    class Model(object):
+        _meta = Meta()
+
+    class Obj(object):
+        content_object = "anything"
+
+    accessor = get_accessor(Model, "content_object", None)
+    assert accessor(Obj()) == "anything"
@@ -0,0 +1,126 @@
+from django.core import management
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import ConnectionError
+import pytest
+from model_mommy import mommy
+
+from djes.conf import settings
+from djes.management.commands import djes_worker
+from djes.management.commands.djes_worker import drain_outbox, get_actions, merge_operations
+from djes.models import IndexingOperation
+
+from example.app.models import SimpleObject
+
+
+@pytest.mark.django_db
+def test_outbox_write_mode(monkeypatch):
+    monkeypatch.setattr(settings, "DJES_WRITE_MODE", "outbox")
+
+    obj = mommy.make(SimpleObject, foo=1)
+    obj.foo = 2
+    obj.save()
+    other = mommy.make(SimpleObject)
+    other_id = other.id
+    other.delete()
+
+    operations = IndexingOperation.objects.order_by("id")
+    assert [(op.object_id, op.op_type) for op in operations] == [
+        (str(obj.id), "index"),
+        (str(obj.id), "index"),
+        (str(other_id), "index"),
+        (str(other_id), "delete"),
+    ]
+    assert operations[0].model == "app.SimpleObject"
+
+    merged = merge_operations(operations)
+    assert len(merged) == 2
+
+    actions = [action for key, action in get_actions(merged)]
+    assert actions[0]["_op_type"] == "index"
+    assert actions[0]["_source"]["foo"] == 2
+    assert actions[1] == {
+        "_op_type": "delete",
+        "_index": "djes-example",
+        "_type": "app_simpleobject",
+        "_id": str(other_id)
+    }
+
+
+@pytest.mark.django_db
+def test_outbox_database(monkeypatch):
+    monkeypatch.setattr(settings, "DJES_WRITE_MODE", "outbox")
+    obj = mommy.make(SimpleObject)
+
+    databases = []
+    db_manager = IndexingOperation.objects.db_manager
+
+    def fake_db_manager(using=None, **kwargs):
+        databases.append(using)
+        return db_manager("default", **kwargs)
+
+    monkeypatch.setattr(IndexingOperation.objects, "db_manager", fake_db_manager)
+    # The outbox row is written through the same database as the object
+    obj._state.db = "other"
+    obj.index()
+    assert databases == ["other"]
+
+
+@pytest.mark.django_db
+def test_djes_worker(es_client, monkeypatch):
+    monkeypatch.setattr(settings, "DJES_WRITE_MODE", "outbox")
+
+    objects = mommy.make(SimpleObject, _quantity=10)
+    objects[0].delete()
+
+    SimpleObject.search_objects.refresh()
+    assert SimpleObject.search_objects.search().count() == 0
+
+    management.call_command("djes_worker", once=True, batch_size=3)
+    assert IndexingOperation.objects.count() == 0
+
+    SimpleObject.search_objects.refresh()
+    assert SimpleObject.search_objects.search().count() == 9
+
+
+@pytest.mark.django_db
+def test_drain_outbox_connection_error(monkeypatch):
+    monkeypatch.setattr(settings, "DJES_WRITE_MODE", "outbox")
+    monkeypatch.setattr(settings, "DJES_BUILD_ALIAS_TTL", None)
+
+    class FakeElasticsearch(Elasticsearch):
+        def bulk(self, *args, **kwargs):
+            raise ConnectionError("N/A", "Connection refused", None)
+
+    mommy.make(SimpleObject, _quantity=2)
+    with pytest.raises(ConnectionError):
+        drain_outbox(FakeElasticsearch())
+    # The batch stays in the outbox to be sent later
+    assert IndexingOperation.objects.count() == 2
+
+
+def test_djes_worker_backoff(monkeypatch):
+    class Stop(Exception):
+        pass
+
+    results = [ConnectionError("N/A", "Connection refused", None)] * 2 + [(0, 0)]
+
+    def fake_drain_outbox(es, batch_size=500, using=None):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    sleeps = []
+
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        if not results:
+            raise Stop()
+
+    monkeypatch.setattr(djes_worker, "drain_outbox", fake_drain_outbox)
+    monkeypatch.setattr(djes_worker.time, "sleep", fake_sleep)
+    with pytest.raises(Stop):
+        management.call_command("djes_worker", sleep=1.0)
+    # Errors back off, and then the worker goes back to its usual sleep
+    assert sleeps == [1.0, 2.0, 1.0]
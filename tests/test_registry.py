@@ -7,7 +7,7 @@ from example.app.models import (
 
 def test_simple():
     assert indexable_registry.all_models.get("app_simpleobject") == SimpleObject
-    assert len(indexable_registry.all_models) == 17
+    assert len(indexable_registry.all_models) == 18
 
 
 def test_base():
@@ -7,6 +7,7 @@ from model_mommy import mommy
 import pytest
 import time
 
+from djes import factory
 from djes.factory import shallow_class_factory
 
 from example.app.models import (
@@ -27,6 +28,34 @@ def test_shallow_factory():
     assert cached_shallow_class == shallow_class
 
 
+def test_shallow_factory_cache(monkeypatch):
+    created = []
+    build_shallow_class = factory._build_shallow_class
+
+    def counting_build_shallow_class(model, name):
+        created.append(model)
+        return build_shallow_class(model, name)
+
+    monkeypatch.setattr(factory, "_build_shallow_class", counting_build_shallow_class)
+
+    hits = [{
+        "_source": {
+            "id": i,
+            "name": "test",
+            "simple_id": i,
+            "nested": {"id": i, "denormalized_datums": "what"},
+        }
+    } for i in range(1000)]
+    for hit in hits:
+        result = RelatableObject.search_objects.from_es(hit)
+        assert result.__class__ is shallow_class_factory(RelatableObject)
+        assert result.nested.__class__ is shallow_class_factory(RelatedNestedObject)
+        assert shallow_class_factory(result.__class__) is result.__class__
+
+    # Every class was already created when the app registry was loaded
+    assert created == []
+
+
 def test_simple_result():
     now = timezone.now()
     hit = {
@@ -95,6 +124,31 @@ def test_reverse_relation_result():
     assert isinstance(test.children.all()[0], ReverseRelationsChildObject)
 
 
+def test_from_es_does_not_modify_hit():
+    now = timezone.now()
+    hit = {
+        "_source": {
+            "id": 123,
+            "tags": [{"id": 1, "name": "one"}],
+            "dumb_tags": [1, 2]
+        }
+    }
+    test = RelationsTestObject.search_objects.from_es(hit)
+    assert test.tags.count() == 1
+    assert hit == {
+        "_source": {
+            "id": 123,
+            "tags": [{"id": 1, "name": "one"}],
+            "dumb_tags": [1, 2]
+        }
+    }
+
+    hit = {"_source": {"id": 1, "published": now.isoformat()}}
+    test = SimpleObject.search_objects.from_es(hit)
+    assert test.published == now
+    assert hit["_source"]["published"] == now.isoformat()
+
+
 @pytest.mark.django_db
 def test_simple_get(es_client):
 
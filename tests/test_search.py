@@ -1,11 +1,18 @@
+import gc
 import pytest
+import threading
+import time
 
+from django.conf import settings as django_settings
 from django.core import management
+from django.db import connection, reset_queries
 
 from elasticsearch_dsl import filter as es_filter
 from model_mommy import mommy
 import six
 
+from djes.conf import settings
+from djes.reindex import get_server_version
 from example.app.models import SimpleObject, ManualMappingObject, Tag
 
 
@@ -97,3 +104,278 @@ def test_search_next_generator(es_client):
     for i in range(search.count()):
         search_results.append(six.next(search))
     assert len(search_results) == 20
+
+
+def test_search_after(fake_es, monkeypatch):
+    hits = fake_es.simple_hits(range(1, 11))
+    for hit in hits:
+        i = hit["_source"]["id"]
+        hit["_source"]["foo"] = i % 3
+        hit["sort"] = [i % 3, "app_simpleobject#{}".format(i)]
+    fake_es.hits = hits = sorted(hits, key=lambda hit: hit["sort"])
+    monkeypatch.setattr(settings, "DJES_SEARCH_AFTER", True)
+
+    search = SimpleObject.search_objects.search().sort("foo")[:4]
+    results = []
+    for i in range(len(hits)):
+        results.append(six.next(search))
+        assert len(search._page) <= 4  # Only the current page is kept
+    with pytest.raises(StopIteration):
+        six.next(search)
+
+    assert [obj.id for obj in results] == [int(hit["_id"]) for hit in hits]
+    bodies = [body for body, params in fake_es.requests]
+    assert len(bodies) == 3
+    assert bodies[0]["sort"] == ["foo", {"_uid": {"order": "asc"}}]
+    assert "from" not in bodies[0] and "search_after" not in bodies[0]
+    assert bodies[2]["search_after"] == hits[7]["sort"]
+
+
+@pytest.mark.django_db
+def test_search_after_index(es_client, monkeypatch):
+    if get_server_version(es_client) < (5, 0):
+        pytest.skip("search_after needs Elasticsearch 5 or later")
+    management.call_command("sync_es")
+    monkeypatch.setattr(settings, "DJES_SEARCH_AFTER", True)
+
+    for i in range(10):
+        mommy.make(SimpleObject, foo=i % 3, baz="paged")
+    SimpleObject.search_objects.refresh()
+
+    search = SimpleObject.search_objects.search().filter(
+        es_filter.Terms(**{"baz": ["paged"]})
+    ).sort("foo")[:4]
+    results = [six.next(search) for _ in range(10)]
+    with pytest.raises(StopIteration):
+        six.next(search)
+    assert sorted(obj.id for obj in results) == sorted(
+        SimpleObject.objects.values_list("id", flat=True))
+    assert [obj.foo for obj in results] == sorted(obj.foo for obj in results)
+
+
+@pytest.mark.django_db
+def test_stream(fake_es):
+    SimpleObject.objects.bulk_create([
+        SimpleObject(id=i, foo=i, bar="bar", baz="baz") for i in range(1, 8)
+    ])
+    fake_es.hits = fake_es.simple_hits(range(1, 8))
+
+    search = SimpleObject.search_objects.search()[:2]
+    assert [obj.id for obj in search.stream(chunk_size=3)] == list(range(1, 8))
+    assert "from" not in fake_es.requests[0][0]
+    assert fake_es.cleared == ["3"]
+
+    try:
+        django_settings.DEBUG = True  # Must be TRUE to track connection queries
+        reset_queries()
+        results = list(search.full().stream(chunk_size=3))
+        assert len(connection.queries) == 3  # One in_bulk() per chunk
+    finally:
+        django_settings.DEBUG = False
+    assert results == list(SimpleObject.objects.order_by("id"))
+
+    # Abandoning the stream clears the scroll
+    stream = search.stream(chunk_size=3)
+    six.next(stream)
+    stream.close()
+    assert fake_es.cleared[-1] == "0"
+
+
+@pytest.mark.django_db
+def test_stream_index(es_client):
+    management.call_command("sync_es")
+
+    mommy.make(SimpleObject, baz="streamed", _quantity=10)
+    SimpleObject.search_objects.refresh()
+
+    ids = sorted(SimpleObject.objects.values_list("id", flat=True))
+    search = SimpleObject.search_objects.search().filter(
+        es_filter.Terms(**{"baz": ["streamed"]})
+    )[:2]
+    assert sorted(obj.id for obj in search.stream(chunk_size=3)) == ids
+    results = list(search.full().stream(chunk_size=3))
+    assert all(isinstance(obj, SimpleObject) for obj in results)
+    assert sorted(obj.id for obj in results) == ids
+
+
+def test_search_prefetch(fake_es):
+    fake_es.hits = fake_es.simple_hits(range(1, 11))
+
+    def requests():
+        return [body["from"] for body, params in fake_es.requests]
+
+    search = SimpleObject.search_objects.search()[:2].prefetch(depth=2)
+    assert six.next(search).id == 1
+
+    # Two fetched pages wait in the background while a third is fetched, and no more
+    for _ in range(50):
+        if len(requests()) == 4:
+            break
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert requests() == [0, 2, 4, 6]
+
+    results = [1] + [obj.id for obj in iter(lambda: next(search, None), None)]
+    assert results == list(range(1, 11))
+
+    # Errors are raised where the page would have been
+    fake_es.fail_from = 8
+    search = SimpleObject.search_objects.search()[:4].prefetch()
+    assert [six.next(search).id for _ in range(8)] == list(range(1, 9))
+    with pytest.raises(ValueError):
+        six.next(search)
+
+
+def test_search_prefetch_abandoned(fake_es):
+    fake_es.hits = fake_es.simple_hits(range(1, 1001))
+
+    def read_ahead_threads():
+        return [t for t in threading.enumerate() if t.name == "djes-read-ahead"]
+
+    search = SimpleObject.search_objects.search()[:2].prefetch()
+    assert six.next(search).id == 1
+    assert read_ahead_threads()
+
+    # Dropping a half-iterated search stops its thread
+    del search
+    gc.collect()
+    for _ in range(100):
+        if not read_ahead_threads():
+            break
+        time.sleep(0.01)
+    assert not read_ahead_threads()
+
+
+def test_search_count(fake_es):
+    fake_es.hits = fake_es.simple_hits(range(1, 26))
+    requests = fake_es.requests
+
+    search = SimpleObject.search_objects.search()
+    assert search.count() == 25
+    assert len(search) == 25
+    assert search
+    assert len(requests) == 1  # The count is cached
+    assert requests[0][0]["size"] == 0
+
+    # Slices only count as far as they go
+    del requests[:]
+    assert len(SimpleObject.search_objects.search()[20:30]) == 5
+    assert len(SimpleObject.search_objects.search()[:10]) == 10
+    assert [params for body, params in requests] == [{"terminate_after": 30},
+                                                     {"terminate_after": 10}]
+
+    # A count that reaches its cap is only a lower bound, but that's cached too
+    del requests[:]
+    search = SimpleObject.search_objects.search()[0:20]
+    assert len(search) == 20
+    assert len(search) == 20
+    assert search
+    assert search
+    assert search.count(cap=5) == 5
+    assert [params for body, params in requests] == [{"terminate_after": 20}]
+    assert search.count(cap=100) == 25
+    assert len(requests) == 2
+
+    del requests[:]
+    search = SimpleObject.search_objects.search()
+    assert search
+    assert search
+    assert len(requests) == 1
+
+    del requests[:]
+    search = SimpleObject.search_objects.search()
+    assert search.exists()
+    assert search.count(cap=10) == 10
+    assert requests[0][1] == {"terminate_after": 1}
+    assert search.count(cap=100) == 25  # Under the cap, so it's exact and cached
+    assert search.count() == 25
+    assert len(requests) == 3
+    assert not SimpleObject.search_objects.search()[:0]
+    assert len(requests) == 3
+
+    # Like len(), bool() of a slice only looks past its start
+    del requests[:]
+    assert SimpleObject.search_objects.search()[20:30]
+    assert not SimpleObject.search_objects.search()[30:40]
+    assert len(SimpleObject.search_objects.search()[30:40]) == 0
+    assert [params for body, params in requests] == [{"terminate_after": 21},
+                                                     {"terminate_after": 31},
+                                                     {"terminate_after": 40}]
+
+    # An executed full() search is counted without loading its hits from the database
+    search = SimpleObject.search_objects.search().full()
+    search.execute()
+    assert search.count() == 25
+    assert not hasattr(search._executed, "_hits")
+
+
+@pytest.mark.django_db
+def test_search_count_index(es_client):
+    management.call_command("sync_es")
+
+    mommy.make(SimpleObject, baz="counted", _quantity=10)
+    SimpleObject.search_objects.refresh()
+
+    search = SimpleObject.search_objects.search().filter(
+        es_filter.Terms(**{"baz": ["counted"]})
+    )
+    assert search.exists()
+    assert search.count(cap=5) == 5
+    assert search.count(cap=100) == 10
+    assert len(search[5:20]) == 5
+    assert search[9:20]
+    assert not search[10:20]
+    assert not SimpleObject.search_objects.search().filter(
+        es_filter.Terms(**{"baz": ["uncounted"]})
+    ).exists()
+
+
+def test_search_getitem(fake_es):
+    fake_es.hits = fake_es.simple_hits(range(1, 31))
+
+    def last_body():
+        return fake_es.requests[-1][0]
+
+    search = SimpleObject.search_objects.search()
+    assert search[25].id == 26
+    assert (last_body()["from"], last_body()["size"]) == (25, 1)
+    assert search[10:20][5].id == 16
+    assert (last_body()["from"], last_body()["size"]) == (15, 1)
+    with pytest.raises(IndexError):
+        search[30]
+    with pytest.raises(IndexError):
+        search[:5][5]
+
+    # Executed results, and the current page of next(), are reused
+    del fake_es.requests[:]
+    assert [obj.id for obj in search] == list(range(1, 11))
+    assert search[3].id == 4
+    assert six.next(search).id == 1
+    assert search[-1].id == 30
+    assert search[12].id == 13
+    assert len(fake_es.requests) == 4  # The search, the page for next(), and the two hits past them
+    search = SimpleObject.search_objects.search()[:5]
+    six.next(search)
+    assert search[4].id == 5
+    assert len(fake_es.requests) == 5
+
+
+@pytest.mark.django_db
+def test_search_getitem_index(es_client):
+    management.call_command("sync_es")
+
+    mommy.make(SimpleObject, baz="sliced", _quantity=15)
+    SimpleObject.search_objects.refresh()
+
+    ids = sorted(SimpleObject.objects.values_list("id", flat=True))
+    search = SimpleObject.search_objects.search().filter(
+        es_filter.Terms(**{"baz": ["sliced"]})
+    ).sort("id")
+    assert search[12].id == ids[12]
+    assert search[5:10][2].id == ids[7]
+    assert search[-1].id == ids[-1]
+    assert six.next(search).id == ids[0]
+    with pytest.raises(IndexError):
+        search[15]
+    with pytest.raises(IndexError):
+        search[:5][5]
@@ -1,4 +1,10 @@
+import pytest
+import six
+
+from djes.conf import settings
+from djes.management.commands.bulk_index import bulk_index, flatten_settings, wait_for_health
 from djes.management.commands.sync_es import get_indexes, sync_index
+from djes.reindex import needs_serializing, new_properties
 
 
 def test_index_settings():
@@ -6,6 +12,79 @@ def test_index_settings():
     assert indexes["djes-example"]["settings"]["index"]["number_of_replicas"] == 1
 
 
+def test_flatten_settings():
+    index_settings = {"index": {"number_of_replicas": 1, "translog": {"durability": "async"}}}
+    assert flatten_settings(index_settings) == {
+        "index.number_of_replicas": 1,
+        "index.translog.durability": "async",
+    }
+
+
+def test_needs_serializing():
+    old = {
+        "testing": {"properties": {"foo": {"type": "string"}}},
+        "nested": {"properties": {"foo": {"properties": {"bar": {"type": "string"}}}}},
+    }
+    new = {
+        "testing": {"properties": {"foo": {"type": "string", "analyzer": "autocomplete"}}},
+        "nested": {"properties": {"foo": {"properties": {"bar": {"type": "integer"}}}}},
+    }
+    assert needs_serializing(old, new) == []
+
+    new["nested"]["properties"]["foo"]["properties"]["baz"] = {"type": "string"}
+    new["other"] = {"properties": {}}
+    assert needs_serializing(old, new) == ["nested", "other"]
+
+
+def test_new_properties():
+    old = {"properties": {"foo": {"type": "string"}, "bar": {"properties": {}}}}
+    new = {
+        "properties": {
+            "foo": {"type": "string", "index": "not_analyzed"},
+            "bar": {"properties": {"baz": {"type": "integer"}}},
+            "qux": {"type": "long"}
+        }
+    }
+    assert new_properties(old, new) == ["bar", "qux"]
+    assert new_properties(new, new) == []
+
+
+@pytest.mark.django_db
+def test_build_index_settings(es_client):
+    index = "djes-example_0099"
+    es_client.indices.delete(index, ignore=[404])
+    es_client.indices.create(index=index, body=get_indexes()["djes-example"])
+
+    bulk_index(es_client, index=index, version=99,
+               index_settings=settings.DJES_BUILD_INDEX_SETTINGS, max_num_segments=1)
+    wait_for_health(es_client, index)
+
+    index_settings = es_client.indices.get_settings(index=index, flat_settings=True)[index]
+    # The replicas come from ES_INDEX_SETTINGS, and the refresh interval from the defaults
+    assert index_settings["settings"]["index.number_of_replicas"] == "1"
+    assert index_settings["settings"]["index.refresh_interval"] == "1s"
+
+    es_client.indices.delete(index)
+
+
+def test_wait_for_health_timeout(monkeypatch):
+    class FakeCluster(object):
+        def health(self, **params):
+            assert params["wait_for_status"] == "green"
+            assert params["timeout"] == "5s"
+            return {"status": "yellow", "timed_out": True}
+
+    class FakeElasticsearch(object):
+        cluster = FakeCluster()
+
+    monkeypatch.setattr(settings, "DJES_BUILD_WAIT_FOR_STATUS", "green")
+    monkeypatch.setattr(settings, "DJES_BUILD_TIMEOUT", 5)
+    out = six.StringIO()
+    # Timing out only warns, so that the alias is still moved
+    assert wait_for_health(FakeElasticsearch(), "djes-example_0099", out=out) is False
+    assert "still yellow after 5 seconds" in out.getvalue()
+
+
 def test_sync_index_exists_without_version(es_client):
     alias_name = 'djes-integration'
     es_client.indices.delete_alias(alias_name + '*', '_all', ignore=[404])
@@ -154,3 +233,69 @@ def test_sync_index(es_client):
 
     es_client.indices.delete_alias("djes-testing-index_*", "_all", ignore=[404])
     es_client.indices.delete("djes-testing-index_*", ignore=[404])
+
+
+def test_sync_index_reindex(es_client, monkeypatch):
+    monkeypatch.setattr(settings, "DJES_BUILD_STRATEGY", "reindex")
+    es_client.indices.delete_alias("djes-testing-index_*", "_all", ignore=[404])
+    es_client.indices.delete("djes-testing-index_*", ignore=[404])
+
+    settings_body = {
+        "mappings": {
+            "testing": {
+                "properties": {
+                    "foo": {"type": "string"},
+                    "bar": {"type": "string"}
+                }
+            }
+        }
+    }
+    sync_index("djes-testing-index", body=settings_body, should_index=True)
+    es_client.index("djes-testing-index", "testing", id=1, body={"foo": "1", "bar": "2"},
+                    refresh=True)
+
+    # Only a type has changed, so the documents are copied across
+    settings_body["mappings"]["testing"]["properties"]["bar"] = {"type": "long"}
+    sync_index("djes-testing-index", body=settings_body, should_index=True)
+    assert list(es_client.indices.get_alias("djes-testing-index")) == ["djes-testing-index_0002"]
+    assert es_client.get("djes-testing-index", "testing", 1)["_source"] == {"foo": "1", "bar": "2"}
+
+    # A new field has to come from the database, which this index doesn't have any models for
+    settings_body["mappings"]["testing"]["properties"]["foo"] = {
+        "properties": {"baz": {"type": "string"}}
+    }
+    sync_index("djes-testing-index", body=settings_body, should_index=True)
+    assert list(es_client.indices.get_alias("djes-testing-index")) == ["djes-testing-index_0003"]
+    assert not es_client.exists("djes-testing-index", "testing", 1)
+
+    es_client.indices.delete_alias("djes-testing-index_*", "_all", ignore=[404])
+    es_client.indices.delete("djes-testing-index_*", ignore=[404])
+
+
+def test_sync_index_per_doc_type(es_client, monkeypatch):
+    monkeypatch.setattr(settings, "DJES_BUILD_STRATEGY", "reindex")
+    es_client.indices.delete_alias("djes-testing-index_*", "_all", ignore=[404])
+    es_client.indices.delete("djes-testing-index_*", ignore=[404])
+
+    settings_body = {
+        "mappings": {
+            "testing": {"properties": {"foo": {"type": "string"}}},
+            "testing-two": {"properties": {"bar": {"type": "string"}}}
+        }
+    }
+    sync_index("djes-testing-index", body=settings_body, should_index=True)
+    es_client.index("djes-testing-index", "testing", id=1, body={"foo": "1"})
+    es_client.index("djes-testing-index", "testing-two", id=1, body={"bar": "2"}, refresh=True)
+
+    # Only "testing-two" has a new field, so "testing" is copied
+    settings_body["mappings"]["testing"]["properties"]["foo"] = {"type": "long"}
+    settings_body["mappings"]["testing-two"]["properties"]["bar"] = {
+        "properties": {"baz": {"type": "string"}}
+    }
+    sync_index("djes-testing-index", body=settings_body, should_index=True)
+    assert list(es_client.indices.get_alias("djes-testing-index")) == ["djes-testing-index_0002"]
+    assert es_client.exists("djes-testing-index", "testing", 1)
+    assert not es_client.exists("djes-testing-index", "testing-two", 1)
+
+    es_client.indices.delete_alias("djes-testing-index_*", "_all", ignore=[404])
+    es_client.indices.delete("djes-testing-index_*", ignore=[404])
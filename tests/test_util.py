@@ -5,8 +5,8 @@ import pytest
 from model_mommy import mommy
 from elasticsearch_dsl.connections import connections
 
-from djes.utils.query import batched_queryset
-from example.app.models import SimpleObject
+from djes.utils.query import batched_queryset, exact_model_filter
+from example.app.models import SimpleObject, ChildObject, GrandchildObject
 
 
 @pytest.mark.django_db
@@ -69,6 +69,20 @@ def test_create_during_query(es_client):
     assert results == (objects + new_objects[:2])
 
 
+@pytest.mark.django_db
+def test_exact_model_filter(es_client):
+    simple = mommy.make(SimpleObject, _quantity=2)
+    child = mommy.make(ChildObject, _quantity=2)
+    grandchild = mommy.make(GrandchildObject, _quantity=2)
+
+    def exact(model):
+        return list(model.objects.filter(**exact_model_filter(model)).order_by("pk"))
+
+    assert exact(SimpleObject) == simple
+    assert exact(ChildObject) == child
+    assert exact(GrandchildObject) == grandchild
+
+
 @pytest.mark.django_db
 def test_delete_object_es(es_client):
     es = connections.get_connection('default')
@@ -0,0 +1,92 @@
+import pytest
+from elasticsearch.helpers import BulkIndexError
+from model_mommy import mommy
+
+from djes.buffer import IndexingBuffer
+from djes.conf import settings
+from djes.worker import IndexingWorker, background_indexing, get_worker
+
+from example.app.models import SimpleObject
+
+
+def make_action(id):
+    return {"_op_type": "index", "_index": "djes-example", "_type": "app_simpleobject", "_id": id,
+            "_source": {"id": id}}
+
+
+def test_worker_drop_policy():
+    worker = IndexingWorker(queue_size=2, full_policy="drop")
+    for id in range(5):
+        worker.put(make_action(id))
+
+    stats = worker.stats()
+    assert stats["queue_depth"] == 2
+    assert stats["enqueued"] == 2
+    assert stats["dropped"] == 3
+    assert stats["lag"] > 0
+
+
+def test_worker_priority():
+    worker = IndexingWorker()
+    with background_indexing():
+        worker.put(make_action(1))
+        worker.put(make_action(2))
+    worker.put(make_action(3))
+
+    items = [worker.queue.get_nowait() for _ in range(3)]
+    assert [item[3]["_id"] for item in items] == [3, 1, 2]
+
+
+def test_worker_superseded(monkeypatch):
+    sent = []
+    monkeypatch.setattr(IndexingBuffer, "flush", lambda self: sent.extend(self.actions.values()))
+
+    worker = IndexingWorker()
+    with background_indexing():
+        worker.put(make_action(1))
+    delete = make_action(1)
+    delete["_op_type"] = "delete"
+    worker.put(delete)
+
+    # The delete is sent first, and the older index operation mustn't undo it
+    worker._send([worker.queue.get_nowait()])
+    worker._send([worker.queue.get_nowait()])
+    assert sent == [delete]
+    assert worker.stats()["superseded"] == 1
+
+
+def test_worker_failures(monkeypatch):
+    def flush(self):
+        # The copy of document 2 sent to an index being rebuilt failed, as did document 3
+        raise BulkIndexError("2 document(s) failed to index.", [
+            {"index": {"_index": "djes-example_0002", "_type": "app_simpleobject", "_id": "2"}},
+            {"index": {"_index": "djes-example_0001", "_type": "app_simpleobject", "_id": "3"}},
+        ])
+    monkeypatch.setattr(IndexingBuffer, "flush", flush)
+
+    worker = IndexingWorker()
+    for id in range(1, 5):
+        worker.put(make_action(id))
+    worker._send([worker.queue.get_nowait() for _ in range(4)])
+    assert (worker.stats()["sent"], worker.stats()["failed"]) == (2, 2)
+
+
+def test_worker_unknown_policy():
+    with pytest.raises(ValueError):
+        IndexingWorker(full_policy="explode")
+
+
+@pytest.mark.django_db
+def test_async_write_mode(es_client, monkeypatch):
+    monkeypatch.setattr(settings, "DJES_WRITE_MODE", "async")
+
+    objects = mommy.make(SimpleObject, _quantity=20)
+    objects[0].delete()
+
+    worker = get_worker()
+    worker.flush()
+    assert worker.queue_depth == 0
+    assert worker.failed == 0
+
+    SimpleObject.search_objects.refresh()
+    assert SimpleObject.search_objects.search().count() == 19